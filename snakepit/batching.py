@@ -0,0 +1,136 @@
+"""
+Group commit: changes from many concurrent requests, committed together.
+
+Under many concurrent writers the database spends most of its time waiting
+for each transaction's commit to reach the disk. Collecting their changes
+into short batches, each committed in one transaction, shares that wait.
+"""
+import Queue
+import logging
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class GroupCommitter(object):
+    """
+    Runs units of work submitted by concurrent threads a batch at a time,
+    in one transaction per batch. A batch starts as soon as there is work,
+    and collects more for up to latency seconds, or until it has batch_size
+    units.
+
+    Each unit runs in a savepoint of its own, so one that fails is rolled
+    back alone, and its error goes to whoever submitted it. If a batch
+    cannot be committed, its units are tried again one transaction each.
+    """
+
+    def __init__(self, open_store, batch_size = 64, latency = 0.005):
+        self.open_store = open_store
+        self.batch_size = batch_size
+        self.latency = latency
+        self.batches = 0
+        self.units = 0
+        self.failures = 0
+        self.retries = 0
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, work):
+        """
+        Run work(store) in the next batch, and wait for it to be committed.
+        Returns what work returned, or raises what it raised. Whatever it
+        returns is detached from the session, but keeps what was loaded.
+        """
+        unit = Unit(work)
+        self._start()
+        self._queue.put(unit)
+        unit.done.wait()
+        if unit.error is not None:
+            raise unit.error[0], unit.error[1], unit.error[2]
+        return unit.result
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(name = "group-commit", target = self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.latency
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout = remaining))
+                except Queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            store = self.open_store()
+        except Exception:
+            error = sys.exc_info()
+            for unit in batch:
+                unit.error = error
+                unit.done.set()
+            return
+        try:
+            try:
+                with store:
+                    store.session.expire_on_commit = False
+                    for unit in batch:
+                        unit.run(store)
+            except Exception:
+                log.exception("Could not commit a batch of %d, trying them one by one", len(batch))
+                for unit in batch:
+                    if unit.error is None:
+                        with self._lock:
+                            self.retries += 1
+                        self._commit_alone(store, unit)
+            with self._lock:
+                self.batches += 1
+                self.units += len(batch)
+                self.failures += sum(1 for unit in batch if unit.error is not None)
+        finally:
+            store.close()
+            for unit in batch:
+                unit.done.set()
+
+    def _commit_alone(self, store, unit):
+        # Nothing from the batch that was rolled back counts.
+        unit.result, unit.error = None, None
+        try:
+            with store:
+                store.session.expire_on_commit = False
+                unit.run(store)
+        except Exception:
+            unit.error = sys.exc_info()
+
+    def statistics(self):
+        with self._lock:
+            return dict(batches = self.batches, units = self.units,
+                    failures = self.failures, retries = self.retries,
+                    mean_batch_size = float(self.units) / self.batches if self.batches else None)
+
+class Unit(object):
+    """A piece of work for a GroupCommitter, and its outcome."""
+
+    def __init__(self, work):
+        self.work = work
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self, store):
+        try:
+            with store.savepoint():
+                self.result = self.work(store)
+        except Exception:
+            self.error = sys.exc_info()
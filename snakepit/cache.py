@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe cache that discards the least recently used
+    entries first. Entries can also be given a time to live, in seconds,
+    after which they are treated as missing.
+
+    The cache is bounded by its number of entries, and optionally also by
+    their total weight (by default the len of each value, eg. its size in
+    bytes). Values heavier than the whole budget are not cached at all.
+    """
+
+    def __init__(self, max_size = 1024, ttl = None, max_weight = None, weigh = len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._d.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            del self._d[key]
+            self._d[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        weight = self.weigh(value) if self.max_weight is not None else 0
+        with self._lock:
+            self._remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self._d[key] = (value, expires, weight)
+            self.weight += weight
+            while len(self._d) > self.max_size or \
+                    (self.max_weight is not None and self.weight > self.max_weight):
+                self._remove(next(iter(self._d)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._d.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._d)
+
+    def statistics(self):
+        lookups = self.hits + self.misses
+        return dict(
+            size = len(self._d),
+            max_size = self.max_size,
+            weight = self.weight,
+            max_weight = self.max_weight,
+            hits = self.hits,
+            misses = self.misses,
+            hit_ratio = float(self.hits) / lookups if lookups else None,
+            evictions = self.evictions)
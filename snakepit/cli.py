@@ -0,0 +1,165 @@
+"""
+Maintenance commands, eg:
+
+    python -m snakepit.cli sweep --batch-size 500
+    python -m snakepit.cli gc --max-batches 100 --pause 0.5
+    python -m snakepit.cli rebalance --limit 10
+"""
+import argparse
+import json
+import sys
+
+import config
+import data
+import maintenance
+import transfer
+from compression import configure_compression
+
+def on_each_shard(command):
+    """
+    Run a command on the database of each shard, if histories are sharded,
+    reporting by shard.
+    """
+    def run(store, args):
+        if not data.shard_urls(store.config):
+            return command(store, args)
+        stores = data.history_stores(store.config)
+        reports = {}
+        for name, shard in stores:
+            try:
+                reports[name] = command(shard, args)
+            finally:
+                shard.close()
+        return reports
+    return run
+
+def sweep(store, args):
+    return maintenance.sweep_expired(store, args.batch_size)
+
+@on_each_shard
+def sweep_payloads(store, args):
+    return maintenance.sweep_payloads(store, args.batch_size, args.grace)
+
+@on_each_shard
+def gc(store, args):
+    return maintenance.collect_garbage(store, args.batch_size, args.max_batches, args.pause)
+
+def fetch_user(store, name):
+    user = store.fetch_user(name = name)
+    if user is None:
+        raise SystemExit("No such user: %s" % (name))
+    return user.id
+
+def export(store, args):
+    user_id = fetch_user(store, args.user)
+    store = data.Store(store.config, read_only = True, user_id = user_id)
+    lines = 0
+    try:
+        for line in transfer.export_lines(store, user_id, args.batch_size):
+            args.output.write(line)
+            lines += 1
+    finally:
+        store.close()
+    return {"exported": lines}
+
+def import_(store, args):
+    user_id = fetch_user(store, args.user)
+    with data.Store(store.config, user_id = user_id) as store:
+        return {"imported": store.import_histories(user_id, transfer.read_lines(args.input), args.batch_size)}
+
+@on_each_shard
+def migrate_jsonb(store, args):
+    with store:
+        return {"migrated": store.migrate_step_data_to_jsonb()}
+
+@on_each_shard
+def migrate_deltas(store, args):
+    with store:
+        return {"added": store.migrate_step_deltas()}
+
+@on_each_shard
+def migrate_payloads(store, args):
+    with store:
+        return store.migrate_step_payloads()
+
+@on_each_shard
+def migrate_histories(store, args):
+    with store:
+        return store.migrate_histories()
+
+def migrate_tokens(store, args):
+    with store:
+        return {"backfilled": store.migrate_token_expiry()}
+
+def rebalance(store, args):
+    return maintenance.rebalance(store.config, args.limit, args.wait, args.batch_size)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "snakepit")
+    parser.add_argument("--mode", help = "configuration mode, eg. TEST")
+    commands = parser.add_subparsers()
+
+    cmd = commands.add_parser("sweep", help = "delete expired OAuth grants and bearer tokens")
+    cmd.add_argument("--batch-size", type = int, default = 1000)
+    cmd.set_defaults(command = sweep)
+
+    cmd = commands.add_parser("sweep-payloads", help = "delete step payloads that no step refers to")
+    cmd.add_argument("--batch-size", type = int, default = 1000)
+    cmd.add_argument("--grace", type = int, default = 3600, help = "keep payloads younger than this, in seconds")
+    cmd.set_defaults(command = sweep_payloads)
+
+    cmd = commands.add_parser("gc", help = "delete steps that no history can reach")
+    cmd.add_argument("--batch-size", type = int, default = 1000)
+    cmd.add_argument("--max-batches", type = int, default = None)
+    cmd.add_argument("--pause", type = float, default = 0, help = "seconds to wait between batches")
+    cmd.set_defaults(command = gc)
+
+    cmd = commands.add_parser("export", help = "write a user's histories and steps as NDJSON")
+    cmd.add_argument("--user", required = True, help = "the user's name")
+    cmd.add_argument("--output", type = argparse.FileType("w"), default = sys.stdout)
+    cmd.add_argument("--batch-size", type = int, default = 1000)
+    cmd.set_defaults(command = export)
+
+    cmd = commands.add_parser("import", help = "add histories and steps from an export to a user")
+    cmd.add_argument("--user", required = True, help = "the user's name")
+    cmd.add_argument("--input", type = argparse.FileType("r"), default = sys.stdin)
+    cmd.add_argument("--batch-size", type = int, default = 1000)
+    cmd.set_defaults(command = import_)
+
+    cmd = commands.add_parser("rebalance", help = "move users onto the shards the ring now gives them")
+    cmd.add_argument("--limit", type = int, default = None, help = "the most users to move")
+    cmd.add_argument("--wait", type = float, default = None,
+            help = "seconds to wait for placements to expire (default SHARD_PLACEMENT_TTL)")
+    cmd.add_argument("--batch-size", type = int, default = 1000)
+    cmd.set_defaults(command = rebalance)
+
+    cmd = commands.add_parser("migrate-jsonb", help = "store step data as indexed JSONB (Postgresql)")
+    cmd.set_defaults(command = migrate_jsonb)
+
+    cmd = commands.add_parser("migrate-histories", help = "add step positions, forks, versions and their indexes")
+    cmd.set_defaults(command = migrate_histories)
+
+    cmd = commands.add_parser("migrate-deltas", help = "add the columns that delta encoded steps need")
+    cmd.set_defaults(command = migrate_deltas)
+
+    cmd = commands.add_parser("migrate-payloads", help = "add the table and column that deduplicated step data needs")
+    cmd.set_defaults(command = migrate_payloads)
+
+    cmd = commands.add_parser("migrate-tokens", help = "store and fill in when bearer tokens expire (Postgresql)")
+    cmd.set_defaults(command = migrate_tokens)
+
+    args = parser.parse_args(argv)
+    conf = config.Config(args.mode)
+    configure_compression(conf)
+    store = data.Store(conf)
+    try:
+        report = args.command(store, args)
+    finally:
+        store.close()
+    # Reports go to stderr when the output is the data itself.
+    out = sys.stderr if getattr(args, "output", None) is sys.stdout else sys.stdout
+    json.dump(report, out, indent = 2, sort_keys = True)
+    out.write("\n")
+
+if __name__ == "__main__":
+    main()
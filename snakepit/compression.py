@@ -0,0 +1,64 @@
+"""
+Compression of stored step data, and of responses.
+
+Compressed values are stored as text, tagged with their codec, eg.
+"gzip:H4sIAAAA...", so that they can be told apart from plain JSON (which
+can never start with a codec name) and old rows still read correctly.
+"""
+import base64
+import zlib
+
+from utils import setting
+
+# HTTP content codings, by the zlib window bits that produce them.
+CODECS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+# Values at least this long are stored compressed. Zero turns it off.
+threshold = 16 * 1024
+level = 6
+
+def configure_compression(config):
+    global threshold, level
+    threshold = setting(config, "STEP_COMPRESSION_THRESHOLD", threshold)
+    level = setting(config, "STEP_COMPRESSION_LEVEL", level)
+
+def compress(data, codec):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    z = zlib.compressobj(level, zlib.DEFLATED, CODECS[codec])
+    return z.compress(data) + z.flush()
+
+def decompress(data, codec):
+    return zlib.decompress(data, CODECS[codec])
+
+def pack(text):
+    """The form to store a JSON encoded value in."""
+    if not threshold or len(text) < threshold:
+        return text
+    return "gzip:" + base64.b64encode(compress(text, "gzip"))
+
+def codec_of(stored):
+    if stored[:5] == "gzip:":
+        return "gzip"
+    return None
+
+def unpack(stored):
+    """The codec a stored value was compressed with, and its compressed bytes."""
+    codec = codec_of(stored)
+    if codec is None:
+        return None, None
+    return codec, base64.b64decode(stored[len(codec) + 1:])
+
+def text_of(stored):
+    """The JSON text of a stored value."""
+    codec, data = unpack(stored)
+    if codec is None:
+        return stored
+    return decompress(data, codec).decode('utf-8')
+
+def peek(stored, size = 64):
+    """The start of the JSON text of a stored value."""
+    codec, data = unpack(stored)
+    if codec is None:
+        return stored[:size]
+    return zlib.decompressobj(CODECS[codec]).decompress(data, size)
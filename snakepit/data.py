@@ -1,23 +1,549 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from schema import User, History, Base, Role, Client, Grant, BearerToken
-from utils import select_keys
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from uuid import uuid4, UUID
+from sqlalchemy import create_engine, event, exc, func, inspect, select, exists, literal_column, and_, or_, cast, text, bindparam, Integer, Text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import ArgumentError
+from sqlalchemy.dialects.postgresql import array, ARRAY
+from sqlalchemy.orm import Session, sessionmaker, joinedload, undefer
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
+from schema import User, UserShard, History, HistoryStep, HistoryConflict, Step, Payload, Base, Role, Client, Grant, BearerToken, \
+        STEP_DATA_INDEX
+from sqltypes import lazy_json, JSONB
+from utils import select_keys, setting, truthy, chunked, json_contains, json_equal, json_path, select_paths, parse_timestamp
+from compression import text_of
+from cache import LRUCache
+from sharding import HashRing
+import delta
+
+class TimedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long callers wait for a connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            with self._stats_lock:
+                self.waits += 1
+                self.wait_time += time.time() - start
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Check a connection is still alive before handing it out, so that
+    connections dropped by the server are replaced rather than failing
+    the request that gets them.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+_engines = {}
+_engines_pid = os.getpid()
+_engines_lock = threading.Lock()
+_inherited_engines = []
+
+def get_engine(config, url = None):
+    """
+    Get the engine for a database url (by default the configured DB_URL).
+
+    Engines, and their connection pools, are shared by every Store in a
+    process. A forked child process gets engines of its own: the ones it
+    inherited are kept referenced but never used, since closing their
+    connections from here would close them for the parent too.
+    """
+    global _engines_pid
+    url = url or config['DB_URL']
+    with _engines_lock:
+        if _engines_pid != os.getpid():
+            _inherited_engines.extend(_engines.values())
+            _engines.clear()
+            _engines_pid = os.getpid()
+        if url not in _engines:
+            _engines[url] = make_engine(config, url)
+        return _engines[url]
+
+def make_engine(config, url):
+    if make_url(url).drivername.startswith("sqlite"):
+        return create_engine(url)
+    engine = create_engine(url,
+            poolclass = TimedQueuePool,
+            pool_size = setting(config, "DB_POOL_SIZE", 5),
+            max_overflow = setting(config, "DB_MAX_OVERFLOW", 10),
+            pool_timeout = setting(config, "DB_POOL_TIMEOUT", 30),
+            pool_recycle = setting(config, "DB_POOL_RECYCLE", 3600))
+    if setting(config, "DB_POOL_PRE_PING", False, truthy):
+        event.listen(engine, "checkout", ping_connection)
+    return engine
+
+def public_url(url):
+    """A database url that is safe to report, with any password hidden."""
+    url = make_url(str(url))
+    if url.password is not None:
+        url.password = "xxx"
+    return str(url)
+
+def pool_statistics():
+    """
+    Report on the connection pools of the engines in this process.
+    """
+    with _engines_lock:
+        engines = dict(_engines)
+    stats = {}
+    for url, engine in engines.items():
+        pool = engine.pool
+        stats[public_url(url)] = dict(
+            size = pool_measure(pool, "size"),
+            checked_in = pool_measure(pool, "checkedin"),
+            checked_out = pool_measure(pool, "checkedout"),
+            overflow = pool_measure(pool, "overflow"),
+            waits = getattr(pool, "waits", None),
+            wait_time = getattr(pool, "wait_time", None))
+    return stats
+
+def pool_measure(pool, name):
+    # Not every kind of pool can tell (SingletonThreadPool.size is not even a method).
+    measure = getattr(pool, name, None)
+    return measure() if callable(measure) else None
+
+_routes = defaultdict(int)
+_routes_lock = threading.Lock()
+_next_replica = [0]
+
+def replica_engines(config):
+    """The engines for the read replicas in DB_REPLICA_URLS, if any."""
+    urls = config.get("DB_REPLICA_URLS") or ""
+    return [get_engine(config, url.strip()) for url in urls.split(",") if url.strip()]
+
+def route(config, read_only = False, sticky = False, shard = None):
+    """
+    Choose the engine for a Store. Stores for a shard go to that shard.
+    Otherwise read only stores go to the replicas in turn, unless they are
+    sticky, ie. their client wrote something recently enough that a replica
+    may not have it yet.
+    """
+    if shard is not None and shard != MAIN_DATABASE:
+        urls = shard_urls(config)
+        if shard not in urls:
+            raise KeyError("No such shard: %s" % (shard))
+        with _routes_lock:
+            _routes["shard"] += 1
+        return get_engine(config, urls[shard])
+    replicas = replica_engines(config) if read_only and not sticky else []
+    with _routes_lock:
+        if replicas:
+            engine = replicas[_next_replica[0] % len(replicas)]
+            _next_replica[0] += 1
+            _routes["replica"] += 1
+        else:
+            engine = get_engine(config)
+            _routes["sticky" if read_only and sticky else "primary"] += 1
+    return engine
+
+def replica_lag(engine):
+    """How many seconds behind its primary a replica is, if that can be told."""
+    if engine.dialect.name != 'postgresql':
+        return None
+    lag = engine.scalar("SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+    return None if lag is None else float(lag)
+
+def routing_statistics(config):
+    """
+    Report how many stores have been sent where (to a replica, to the
+    primary, or to the primary because they were sticky), and the lag of
+    each replica.
+    """
+    lags = {}
+    for engine in replica_engines(config):
+        try:
+            lags[public_url(engine.url)] = replica_lag(engine)
+        except exc.DBAPIError as e:
+            lags[public_url(engine.url)] = str(e.orig)
+    with _routes_lock:
+        routes = dict(_routes)
+    return dict(routes = routes, replica_lag = lags)
+
+def shard_urls(config):
+    """
+    The databases that users' histories and steps are sharded across, by
+    name, from DB_SHARDS, eg. "a=postgresql://db1/snakepit,b=postgresql://db2/snakepit".
+    Empty if they are not sharded, and all live in the main database.
+    """
+    spec = config.get("DB_SHARDS") or ""
+    urls = dict(part.strip().split("=", 1) for part in spec.split(",") if part.strip())
+    if MAIN_DATABASE in urls:
+        raise ArgumentError("The shard name %r is reserved for the main database" % (MAIN_DATABASE))
+    return urls
+
+# Where the histories of users who had them before DB_SHARDS was set stay,
+# in the main database, until maintenance.rebalance moves them to a shard.
+MAIN_DATABASE = "main"
+
+_rings = {}
+
+def shard_ring(config):
+    """
+    The ring that places users on shards. Shards named in DB_DRAINING_SHARDS
+    are left off it, so that rebalancing moves everyone off them.
+    """
+    draining = set(name.strip() for name in (config.get("DB_DRAINING_SHARDS") or "").split(","))
+    names = tuple(sorted(set(shard_urls(config)) - draining))
+    if names not in _rings:
+        _rings[names] = HashRing(names)
+    return _rings[names]
+
+class AlreadyImported(Exception):
+    """Some of the histories being imported, or their steps, are stored already."""
+
+class UserMoving(Exception):
+    """A user's histories are being moved between shards, and cannot be changed."""
+
+# The shard each user is on, and whether they are being moved, by user id.
+placements = LRUCache(max_size = 100000)
+
+def shard_of(config, user_id, read_only = False):
+    """
+    The name of the shard that holds a user's histories, or None if they
+    are not sharded. Users stay on the shard they were first placed on,
+    until they are moved (see maintenance.rebalance). Placements are cached
+    for SHARD_PLACEMENT_TTL seconds, which is how long moving waits for.
+
+    Raises UserMoving when the user is being moved, unless only reading.
+    """
+    if not shard_urls(config):
+        return None
+    placement = placements.get(str(user_id))
+    if placement is None:
+        with Store(config) as directory:
+            placement = directory.user_placement(user_id)
+        placements.put(str(user_id), placement, setting(config, "SHARD_PLACEMENT_TTL", 5, float))
+    shard, moving = placement
+    if moving and not read_only:
+        raise UserMoving(user_id)
+    return shard
+
+def history_stores(config):
+    """
+    Stores for each of the databases that hold histories and steps, as
+    (shard, store) pairs: one for each shard and (MAIN_DATABASE, store) for
+    the histories not moved onto one yet, or just (None, store) for the
+    main database if they are not sharded.
+    """
+    names = sorted(shard_urls(config))
+    if not names:
+        return [(None, Store(config))]
+    return [(name, Store(config, shard = name)) for name in names + [MAIN_DATABASE]]
+
+def retrying(work, attempts = 5, backoff = 0.01):
+    """
+    Call work() until it does not lose a race with a concurrent writer (ie.
+    raise HistoryConflict), up to attempts times, waiting for a random and
+    exponentially growing time between attempts.
+    """
+    for attempt in range(attempts):
+        try:
+            return work()
+        except HistoryConflict:
+            if attempt + 1 >= attempts:
+                raise
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+def chain_order(links):
+    """
+    The step ids of (step_id, prev_step_id) pairs, given in the order the
+    steps were made, with each step after the one before it. Steps that
+    cannot be reached from the first are put last, in the order given.
+    """
+    ids = set(step_id for step_id, prev_id in links)
+    after = defaultdict(list)
+    for step_id, prev_id in links:
+        after[prev_id if prev_id in ids else None].append(step_id)
+    order, todo = [], list(reversed(after[None]))
+    while todo:
+        step_id = todo.pop()
+        order.append(step_id)
+        todo.extend(reversed(after[step_id]))
+    placed = set(order)
+    return order + [step_id for step_id, prev_id in links if step_id not in placed]
+
+# Matches any value, including None (ie. JSON null).
+ANY = object()
+
+def value_at(column, path):
+    """
+    The value at a path of keys in a JSONB column, with #>. The path is
+    cast, as Postgresql cannot tell the type of an empty array.
+    """
+    return column.op("#>")(cast(array(path), ARRAY(Text)))
+
+_listeners = defaultdict(list)
+
+def listen(event_name, listener):
+    """
+    Call listener(*args) for each event of the given name that a Store
+    records, once the transaction that recorded it has been committed.
+
+    Events:
+      user_changed (user_id) -- a user, or their roles, changed.
+      token_revoked (access_token, refresh_token) -- a bearer token was deleted.
+      steps_added (history_id, start, end) -- steps were appended to a history.
+      history_forked (history_id, fork_id, fork_point) -- a history was forked.
+      histories_deleted (user_id) -- all of a user's histories were deleted.
+      steps_deleted (count) -- unreachable steps were deleted.
+
+    On Postgresql, the history events are also sent to every process that
+    is listening for them, as notifications on the CHANNEL channel (see
+    subscriptions).
+    """
+    _listeners[event_name].append(listener)
+
+def unlisten(event_name, listener):
+    """Stop calling a listener added with listen, if it was."""
+    if listener in _listeners[event_name]:
+        _listeners[event_name].remove(listener)
+
+# Payloads are inserted by whichever transaction gets there first (Postgresql 9.5+).
+PAYLOAD_INSERT = text("INSERT INTO payloads (digest, data, created_at) VALUES (:digest, :data, :created_at) "
+                      "ON CONFLICT (digest) DO NOTHING",
+                      bindparams = [bindparam("data", type_ = Payload.data.type)])
+
+# A payload that an append reuses is locked until the steps that refer to it
+# are committed, and sweeping unused payloads skips the locked ones, rather
+# than deleting one from under a step that is about to refer to it.
+PAYLOAD_LOCK = text("SELECT digest FROM payloads WHERE digest = ANY(:digests) ORDER BY digest FOR KEY SHARE")
+PAYLOAD_SWEEP = text("DELETE FROM payloads WHERE digest IN ("
+                     "SELECT digest FROM payloads WHERE created_at < :before "
+                     "AND NOT EXISTS (SELECT 1 FROM steps WHERE steps.payload_digest = payloads.digest) "
+                     "LIMIT :limit FOR UPDATE SKIP LOCKED)",
+                     bindparams = [bindparam("before", type_ = Payload.created_at.type)])
+
+# A shard has copies of its users, and their histories and steps.
+SHARD_TABLES = [User.__table__, History.__table__, HistoryStep.__table__, Step.__table__, Payload.__table__]
+
+CHANNEL = "snakepit_history_events"
+BROADCAST_EVENTS = ("steps_added", "history_forked")
+
+class StoreSession(Session):
+    """
+    A session that reports a claimed history (see History.claim) that was
+    changed by someone else as a HistoryConflict, whenever it is flushed.
+    """
+
+    def flush(self, objects = None):
+        claimed = [obj.id for obj in self.dirty if isinstance(obj, History)]
+        try:
+            super(StoreSession, self).flush(objects)
+        except StaleDataError:
+            if not claimed:
+                raise
+            raise HistoryConflict("History %s has been changed since it was loaded" % (claimed[0]))
 
 class Store(object):
+    """
+    Access to the database, in one session at a time.
 
-    def __init__(self, config):
-        self.__engine__ = create_engine(config['DB_URL'])
-        self._session_factory = sessionmaker(bind = self.__engine__)
+    Stores that are only going to read can be opened read_only, to use a
+    replica if there are any (see route). Stores for a user's histories
+    and steps can be given their user_id, to use the shard that holds them
+    (see shard_of), or opened on a given shard.
+    """
+
+    def __init__(self, config, read_only = False, sticky = False, user_id = None, shard = None):
+        if shard is None and user_id is not None:
+            shard = shard_of(config, user_id, read_only)
+        self.config = config
+        self.shard = shard
+        self.__engine__ = route(config, read_only, sticky, shard)
+        # Whether this store has committed a transaction that wrote anything.
+        self.committed = False
+        self._wrote = False
+        self._session_factory = sessionmaker(bind = self.__engine__, class_ = StoreSession)
         self._session = None
+        self._events = []
+        # Zero stores every step in full.
+        self.keyframe_interval = setting(config, "STEP_KEYFRAME_INTERVAL", 0)
+        self.deduplicate = setting(config, "STEP_DEDUPLICATION", False, truthy)
 
     @property
     def session(self):
         if self._session is None:
             self._session = self._session_factory()
+            event.listen(self._session, "before_flush", self._encode_steps)
+            event.listen(self._session, "after_flush", self._record_changes)
+            event.listen(self._session, "after_begin", self._watch_writes)
         return self._session
 
+    def _watch_writes(self, session, transaction, connection):
+        if not transaction.nested:
+            self._wrote = False
+            event.listen(connection, "after_cursor_execute", self._record_write)
+
+    def _record_write(self, conn, cursor, statement, parameters, context, executemany):
+        # Flushes and Core statements alike, but not inserts that do nothing on conflict.
+        if cursor.rowcount != 0 and statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self._wrote = True
+
+    def _encode_steps(self, session, flush_context, instances):
+        new_steps = [obj for obj in session.new if isinstance(obj, Step)]
+        if self.keyframe_interval > 1:
+            self._encode_deltas(new_steps)
+        if self.deduplicate:
+            self._deduplicate([s for s in new_steps if not s.depth and s.stored_data is not None])
+
+    def _encode_deltas(self, new_steps):
+        """
+        Store new steps as patches against their previous steps, where that
+        is smaller, with a keyframe every keyframe_interval steps.
+        """
+        new_steps = set(new_steps)
+        while new_steps:
+            step = new_steps.pop()
+            # Previous steps have to be encoded first, so their depth is known.
+            while step.previous_step in new_steps:
+                new_steps.add(step)
+                step = step.previous_step
+                new_steps.remove(step)
+            self._encode_delta(step)
+
+    def _encode_delta(self, step):
+        prev = step.previous_step
+        if prev is not None and (prev.depth or 0) + 1 < self.keyframe_interval:
+            ops = self._delta(delta.plain(prev.data), delta.plain(step.data))
+            if ops is not None:
+                step.store_delta(ops, (prev.depth or 0) + 1)
+
+    def _deduplicate(self, new_steps):
+        """
+        Store the data of new steps as payloads, only adding the payloads
+        that are not stored already.
+        """
+        payloads = {}
+        for step in new_steps:
+            text, digest = Payload.encode(step.data)
+            payloads[digest] = text
+            step.store_payload(digest)
+        self._add_payloads(payloads)
+
+    def _add_payloads(self, payloads):
+        """
+        Store the payloads (JSON text by digest) that are not stored already.
+        Other transactions may be adding the same ones at the same time, so
+        inserts that conflict are skipped: with ON CONFLICT DO NOTHING on
+        Postgresql, and elsewhere by inserting each one in a savepoint.
+        """
+        new_payloads = sorted(set(payloads) - self._known_payloads(payloads))
+        rows = [dict(digest = d, data = lazy_json(payloads[d]), created_at = datetime.now()) for d in new_payloads]
+        if not rows:
+            return
+        if self.__engine__.dialect.name == 'postgresql':
+            self.session.execute(PAYLOAD_INSERT, rows)
+            return
+        for row in rows:
+            try:
+                with self.savepoint():
+                    self.session.execute(Payload.__table__.insert(), row)
+            except exc.IntegrityError:
+                pass
+
+    def _known_payloads(self, digests):
+        """
+        The digests of those payloads that are stored already. On Postgresql
+        they stay locked until this transaction ends, so that they are not
+        swept before the steps that reuse them are committed.
+        """
+        digests = sorted(set(digests))
+        if not digests:
+            return set()
+        if self.__engine__.dialect.name == 'postgresql':
+            return set(d for d, in self.session.execute(PAYLOAD_LOCK, dict(digests = digests)))
+        return set(d for d, in self.session.query(Payload.digest).filter(Payload.digest.in_(digests)))
+
+    def _delta(self, prev_doc, doc):
+        """A patch from one step's data to the next, if it is the smaller."""
+        ops = delta.diff(prev_doc, doc)
+        if len(json.dumps(ops)) < len(json.dumps(doc)):
+            return ops
+        return None
+
+    def notify(self, event_name, *args):
+        """
+        Record an event, to be published when the transaction commits.
+        """
+        self._events.append((event_name, args))
+
+    def _record_changes(self, session, flush_context):
+        for obj in list(session.dirty) + list(session.deleted):
+            if isinstance(obj, User):
+                self.notify("user_changed", obj.id)
+        added = defaultdict(list)
+        for obj in session.new:
+            if isinstance(obj, HistoryStep):
+                added[obj.history_id].append(obj.position)
+        for history_id, positions in added.items():
+            self.notify("steps_added", history_id, min(positions), max(positions) + 1)
+
+    def _broadcast(self):
+        """
+        On Postgresql, send the history events recorded so far as
+        notifications, which are delivered if and when the transaction
+        commits.
+        """
+        if self.__engine__.dialect.name != 'postgresql':
+            return
+        self.session.flush()
+        for event_name, args in self._events:
+            if event_name in BROADCAST_EVENTS:
+                payload = json.dumps([event_name] + list(args), default = str)
+                self.session.execute(select([func.pg_notify(CHANNEL, payload)]))
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Run a block in a savepoint, rolling it back, along with any events
+        it recorded, if it raises.
+        """
+        savepoint, recorded = self.session.begin_nested(), len(self._events)
+        try:
+            yield self
+            savepoint.commit()
+        except:
+            savepoint.rollback()
+            del self._events[recorded:]
+            raise
+
+    def _publish(self):
+        events, self._events = self._events, []
+        for event_name, args in events:
+            for listener in _listeners[event_name]:
+                listener(*args)
+
     def create_db(self):
-        Base.metadata.create_all(self.__engine__)
+        """Create the tables, or on a shard only those that hold histories."""
+        tables = SHARD_TABLES if self.shard not in (None, MAIN_DATABASE) else None
+        Base.metadata.create_all(self.__engine__, tables = tables)
+
+    def _is_integrity_error(self, e):
+        # Newer drivers raise subclasses of IntegrityError, that SQLAlchemy does not wrap as one.
+        return isinstance(e.orig, self.__engine__.dialect.dbapi.IntegrityError)
 
     def clear_db(self):
         Base.metadata.drop_all(self.__engine__)
@@ -32,6 +558,18 @@ class Store(object):
             self.session.add(r)
         return r
 
+    def grant_role(self, user, name):
+        r = self.get_role(name)
+        if r not in user.roles:
+            user.roles.append(r)
+        return r
+
+    def revoke_role(self, user, name):
+        r = self.get_role(name)
+        if r in user.roles:
+            user.roles.remove(r)
+        return r
+
     def add_user(self, data):
         u = User(**select_keys(data, ["name", "password", "email"]))
         r = self.get_role("user")
@@ -40,21 +578,632 @@ class Store(object):
         return u
 
     def fetch_user(self, **args):
-        if args["name"] is None and args["id"] is None:
+        if args.get("name") is None and args.get("id") is None:
             raise ArgumentError("name or id required")
         return self.session.query(User).filter_by(**args).first()
 
+    def copy_user(self, user):
+        """
+        Add a copy of a user from another database, eg. to a shard, without
+        their password or roles, unless there is one already.
+        """
+        if self.session.query(User).get(user.id) is None:
+            self.session.add(User(user.name, user.email, None, id = user.id))
+
+    def user_placement(self, user_id):
+        """
+        The (shard, moving) placement of a user, placing them on the shard
+        that the ring gives them if they have not been placed yet, or on
+        MAIN_DATABASE if they already have histories there.
+        """
+        placement = self.session.query(UserShard).get(user_id)
+        if placement is None:
+            placement = self._place_user(user_id)
+        return placement.shard, placement.moving
+
+    def _place_user(self, user_id):
+        unsharded = self.session.query(History.id).filter(History.user_id == user_id).first() is not None
+        placement = UserShard(user_id = user_id, moving = False,
+                shard = MAIN_DATABASE if unsharded else shard_ring(self.config).node_for(str(user_id)))
+        try:
+            with self.savepoint():
+                self.session.add(placement)
+                self.session.flush()
+        except exc.DBAPIError as e:
+            # Placed by a concurrent request, which copies them to their shard.
+            if not self._is_integrity_error(e):
+                raise
+            return self.session.query(UserShard).get(user_id)
+        user = self.session.query(User).get(user_id)
+        if user is not None and not unsharded:
+            with Store(self.config, shard = placement.shard) as shard:
+                shard.copy_user(user)
+        return placement
+
+    def place_unsharded_users(self):
+        """
+        Place every user who has histories in the main database, but no
+        placement yet, on MAIN_DATABASE, so that rebalance moves them.
+        Returns how many were placed.
+        """
+        placed = select([UserShard.user_id]).where(UserShard.user_id == History.user_id)
+        unplaced = self.session.query(History.user_id).filter(~exists(placed)).distinct().all()
+        for user_id, in unplaced:
+            self.session.add(UserShard(user_id = user_id, shard = MAIN_DATABASE, moving = False))
+        return len(unplaced)
+
+    def set_placement(self, user_id, shard, moving = False):
+        self.session.query(UserShard).filter(UserShard.user_id == user_id).\
+                update(dict(shard = shard, moving = moving), synchronize_session = False)
+
+    def misplaced_users(self, limit = None):
+        """
+        The users who are not on the shard the ring now gives them, eg.
+        because a shard has been added, as (user_id, shard, owner) triples.
+        """
+        ring = shard_ring(self.config)
+        placed = self.session.query(UserShard.user_id, UserShard.shard).order_by(UserShard.user_id)
+        misplaced = ((user_id, shard, ring.node_for(str(user_id))) for user_id, shard in placed)
+        return [m for m in misplaced if m[1] != m[2]][:limit]
+
     def fetch_history(self, **args):
         filt = select_keys(args, ['name', 'id'])
         return self.session.query(History).filter_by(**filt).first()
 
+    def list_histories(self, user_id, after = None, limit = 50):
+        """
+        Get a page of a user's histories, ordered by (created_at, id) and
+        starting after the given (created_at, id) pair, if any.
+
+        Each history comes with its length and the time it last changed,
+        computed by the same query rather than by loading its steps.
+        """
+        last_position = select([func.max(HistoryStep.position)]).\
+                where(HistoryStep.history_id == History.id).\
+                correlate(History).\
+                as_scalar()
+        last_change = select([Step.created_at]).\
+                where(Step.id == HistoryStep.step_id).\
+                where(HistoryStep.history_id == History.id).\
+                where(HistoryStep.position == last_position).\
+                correlate(History).\
+                as_scalar()
+        q = self.session.query(History,
+                func.coalesce(last_position + 1, History.fork_point),
+                func.coalesce(last_change, History.created_at)).\
+                filter(History.user_id == user_id)
+        if after is not None:
+            created_at, history_id = after
+            q = q.filter(or_(History.created_at > created_at,
+                and_(History.created_at == created_at, History.id > history_id)))
+        return q.order_by(History.created_at, History.id).limit(limit).all()
+
+    def get_step(self, step_id):
+        return self.session.query(Step).get(step_id)
+
+    def select_step_data(self, step_id, paths):
+        """
+        Get a step, along with the parts of its data at some paths of keys,
+        without loading the rest of it. Missing values are ANY. Returns
+        None if there is no such step.
+
+        On Postgresql the values are extracted in the database, elsewhere
+        they are picked out of the stored text. Either way the data of a
+        deduplicated step is read from its payload. Only delta encoded
+        steps are rebuilt whole.
+        """
+        stored = func.coalesce(Step.data, Payload.data)
+        if self.__engine__.dialect.name == 'postgresql':
+            cols = [cast(value_at(stored, path), Text) for path in paths]
+        else:
+            cols = [cast(stored, Text)]
+        row = self.session.query(Step, *cols).outerjoin(Step.payload).filter(Step.id == step_id).first()
+        if row is None:
+            return None
+        if row[0].depth:
+            values = [json_path(row[0].data, path, ANY) for path in paths]
+        elif self.__engine__.dialect.name == 'postgresql':
+            values = [ANY if raw is None else json.loads(raw) for raw in row[1:]]
+        elif row[1] is None:
+            values = [ANY] * len(paths)
+        else:
+            values = select_paths(text_of(row[1]), paths, ANY)
+        return row[0], values
+
+    def fetch_step(self, history_id, idx):
+        """
+        Get the step at the given position in a history, or None.
+        """
+        h = self.session.query(History).get(history_id)
+        if h is None:
+            return None
+        return h.step_at(idx)
+
+    def history_length(self, history_id):
+        """
+        Get the number of steps in a history, without loading them.
+        """
+        return self.session.query(func.coalesce(func.max(HistoryStep.position) + 1, History.fork_point)).\
+                            select_from(History).\
+                            outerjoin(History.links).\
+                            filter(History.id == history_id).\
+                            group_by(History.fork_point).\
+                            scalar()
+
+    def append_steps(self, history, records, batch_size = 1000):
+        """
+        Append steps to a history, in order, using bulk inserts. Records are
+        dicts of tool, mimetype and data, and may come from any iterable,
+        which is consumed a batch at a time.
+
+        Returns the position of the first new step and the new step ids.
+        Raises HistoryConflict if something else has appended to the history
+        since it was loaded (see retrying).
+        """
+        start = history.length()
+        previous = history.step_at(start - 1)
+        prev_id = previous.id if previous is not None else None
+        prev_doc, depth = None, 0
+        if previous is not None and self.keyframe_interval > 1:
+            prev_doc, depth = delta.plain(previous.data), previous.depth or 0
+        step_ids = []
+        for batch in chunked(records, batch_size):
+            steps, links, payloads = [], [], {}
+            for record in batch:
+                step_id = uuid4()
+                data, patch, depth = record["data"], None, depth + 1
+                if self.keyframe_interval > 1:
+                    doc = delta.plain(data)
+                    if prev_doc is not None and depth < self.keyframe_interval:
+                        patch = self._delta(prev_doc, doc)
+                    prev_doc = doc
+                if patch is None:
+                    depth = 0
+                else:
+                    data = None
+                digest = None
+                if self.deduplicate and data is not None:
+                    text, digest = Payload.encode(data)
+                    payloads[digest], data = text, None
+                steps.append(dict(id = step_id,
+                    created_at = datetime.now(),
+                    tool = record["tool"],
+                    mimetype = record["mimetype"],
+                    data = data,
+                    patch = patch,
+                    depth = depth,
+                    payload_digest = digest,
+                    prev_step_id = prev_id))
+                links.append(dict(histories_id = history.id,
+                    position = start + len(step_ids),
+                    steps_id = step_id))
+                step_ids.append(step_id)
+                prev_id = step_id
+            self._insert_steps(steps, payloads)
+            try:
+                self.session.execute(HistoryStep.__table__.insert(), links)
+            except exc.DBAPIError as e:
+                # Someone else took these positions first.
+                if not self._is_integrity_error(e):
+                    raise
+                raise HistoryConflict("History %s has been changed since it was loaded" % (history.id))
+        self.session.expire(history, ["links"])
+        history.claim()
+        if step_ids:
+            self.notify("steps_added", history.id, start, start + len(step_ids))
+        return start, step_ids
+
+    def _insert_steps(self, steps, payloads):
+        """
+        Insert step rows, and those of their payloads (JSON text by digest)
+        that are not stored already, with one executemany each.
+        """
+        self._add_payloads(payloads)
+        if steps:
+            self.session.execute(Step.__table__.insert(), steps)
+
+    def export_histories(self, user_id, batch_size = 1000):
+        """
+        Stream a user's histories, the steps they lead to and the places of
+        those steps in them, as ("history", History), ("step", Step) and
+        ("link", (history_id, position, step_id)) pairs, in an order that
+        they can be imported in. Rows are fetched batch_size at a time,
+        using server side cursors where the database has them.
+        """
+        histories = self.session.query(History).\
+                                 filter(History.user_id == user_id).\
+                                 order_by(History.created_at, History.id)
+        for h in self._stream(histories, batch_size):
+            yield "history", h
+
+        # Each step after the one before it: by how far it is from the first.
+        found = self._user_steps(user_id)
+        ordered = select([found.c.id, literal_column("0", Integer).label("generation")]).\
+                  where(found.c.prev_step_id == None).\
+                  cte("ordered", recursive = True)
+        later = found.alias("later")
+        ordered = ordered.union_all(select([later.c.id, (ordered.c.generation + literal_column("1", Integer)).label("generation")]).\
+                                    where(later.c.prev_step_id == ordered.c.id))
+        reachable = self.session.query(Step).\
+                                 join(ordered, Step.id == ordered.c.id).\
+                                 options(undefer(Step.data), joinedload(Step.payload)).\
+                                 order_by(ordered.c.generation, Step.created_at, Step.id)
+        for s in self._stream(reachable, batch_size):
+            yield "step", s
+
+        links = self.session.query(HistoryStep.history_id, HistoryStep.position, HistoryStep.step_id).\
+                             join(History, History.id == HistoryStep.history_id).\
+                             filter(History.user_id == user_id).\
+                             order_by(HistoryStep.history_id, HistoryStep.position)
+        for link in self._stream(links, batch_size):
+            yield "link", link
+
+    def _user_steps(self, user_id):
+        """Every step in a user's histories, and every step before those, as a CTE."""
+        steps = Step.__table__
+        linked = select([HistoryStep.step_id]).\
+                 select_from(HistoryStep.__table__.join(History.__table__)).\
+                 where(History.user_id == user_id)
+        found = select([steps.c.id, steps.c.prev_step_id]).\
+                where(steps.c.id.in_(linked)).\
+                cte("found", recursive = True)
+        step = steps.alias()
+        return found.union(select([step.c.id, step.c.prev_step_id]).where(step.c.id == found.c.prev_step_id))
+
+    def _stream(self, query, batch_size):
+        return query.execution_options(stream_results = True).yield_per(batch_size)
+
+    def import_histories(self, user_id, records, batch_size = 1000):
+        """
+        Add exported histories, steps and links (as dicts, in the order they
+        were exported in) for a user, keeping their ids, with a bulk insert
+        for each batch. Steps that are stored already are skipped, as they
+        may be shared with other users' histories.
+
+        Records may only refer to histories and steps in the same export,
+        or to ones the user already has: a ValueError is raised for any
+        other. Raises AlreadyImported if a history or link is stored already.
+
+        Returns the number of each kind of record added.
+        """
+        counts = dict(history = 0, step = 0, link = 0)
+        imported = dict(history = set(), step = set())
+        batch, kind = [], None
+        try:
+            for record in records:
+                if batch and (record["type"] != kind or len(batch) == batch_size):
+                    counts[kind] += self._import_batch(kind, batch, user_id, imported)
+                    batch = []
+                kind = record["type"]
+                batch.append(record)
+            if batch:
+                counts[kind] += self._import_batch(kind, batch, user_id, imported)
+        except exc.DBAPIError as e:
+            if not self._is_integrity_error(e):
+                raise
+            raise AlreadyImported(str(e.orig))
+        return counts
+
+    def _import_batch(self, kind, records, user_id, imported):
+        if kind == "history":
+            parents = set(str(UUID(r["parent_id"])) for r in records if r["parent_id"] is not None)
+            parents -= imported["history"] | set(str(UUID(r["id"])) for r in records)
+            if parents:
+                owned = self.session.query(History.id).\
+                                     filter(History.id.in_(parents), History.user_id == user_id)
+                self._refuse("history", parents - set(str(i) for i, in owned))
+            self.session.execute(History.__table__.insert(), [dict(
+                id = r["id"], name = r["name"], created_at = parse_timestamp(r["created_at"]),
+                user_id = user_id, parent_id = r["parent_id"], fork_point = r["fork_point"]) \
+                for r in records])
+            imported["history"].update(str(UUID(r["id"])) for r in records)
+            return len(records)
+        if kind == "link":
+            self._refuse("history", set(str(UUID(r["history_id"])) for r in records) - imported["history"])
+            self._check_steps(user_id, set(str(UUID(r["step_id"])) for r in records) - imported["step"])
+            self.session.execute(HistoryStep.__table__.insert(), [dict(
+                histories_id = r["history_id"], position = r["position"], steps_id = r["step_id"]) \
+                for r in records])
+            return len(records)
+
+        ids = [r["id"] for r in records]
+        stored = set(str(i) for i, in self.session.query(Step.id).filter(Step.id.in_(ids)))
+        added = imported["step"] | (set(str(UUID(i)) for i in ids) - stored)
+        # Steps that are stored already, and the steps before these, must be the user's.
+        previous = set(str(UUID(r["prev_step_id"])) for r in records if r["prev_step_id"] is not None)
+        self._check_steps(user_id, stored | (previous - added))
+        steps, payloads = [], {}
+        for r in records:
+            if str(UUID(r["id"])) in stored:
+                continue
+            data, digest = r["data"], None
+            if self.deduplicate and data is not None:
+                text, digest = Payload.encode(data)
+                payloads[digest], data = text, None
+            steps.append(dict(id = r["id"], created_at = parse_timestamp(r["created_at"]),
+                tool = r["tool"], mimetype = r["mimetype"], data = data, patch = None, depth = 0,
+                payload_digest = digest, prev_step_id = r["prev_step_id"]))
+        self._insert_steps(steps, payloads)
+        imported["step"].update(str(UUID(i)) for i in ids)
+        return len(steps)
+
+    def _check_steps(self, user_id, step_ids):
+        """Refuse any of some steps that are not in (or before) the user's histories."""
+        if step_ids:
+            found = self._user_steps(user_id)
+            reachable = self.session.execute(select([found.c.id]).where(found.c.id.in_(step_ids)))
+            self._refuse("step", step_ids - set(str(i) for i, in reachable))
+
+    def _refuse(self, kind, ids):
+        if ids:
+            raise ValueError("Not a %s in this export or of yours: %s" % (kind, sorted(ids)[0]))
+
+    def delete_histories(self, user_id):
+        """
+        Delete all of a user's histories, returning how many there were.
+        Their steps are left for collect_garbage, as other histories may
+        share them.
+        """
+        histories = select([History.id]).where(History.user_id == user_id)
+        self.session.execute(HistoryStep.__table__.delete().where(HistoryStep.history_id.in_(histories)))
+        deleted = self.session.execute(History.__table__.delete().where(History.user_id == user_id)).rowcount
+        if deleted:
+            self.notify("histories_deleted", user_id)
+        return deleted
+
+    def step_ancestry(self, step_id, max_depth = None):
+        """
+        Get the chain of steps leading to a step, nearest first, starting
+        with the step itself at depth 0.
+        """
+        return self._walk_steps(step_id, max_depth, lambda step, found: step.c.id == found.c.prev_step_id)
+
+    def step_descendants(self, step_id, max_depth = None):
+        """
+        Get every step that grew from a step, on any branch, breadth first,
+        starting with the step itself at depth 0.
+        """
+        return self._walk_steps(step_id, max_depth, lambda step, found: step.c.prev_step_id == found.c.id)
+
+    def _walk_steps(self, step_id, max_depth, follows):
+        """
+        Find the steps reachable from a step in a single recursive query,
+        returning (step, depth, history_id, position) tuples, where history_id
+        and position say where the step was added (if it is still there).
+        """
+        # Integers are inlined, as SQLAlchemy 0.8 can misorder positional
+        # parameters in CTEs, leaving the step id as the only parameter.
+        steps = Step.__table__
+        found = select([steps.c.id, steps.c.prev_step_id, literal_column("0", Integer).label("depth")]).\
+                where(steps.c.id == step_id).\
+                cte("found", recursive = True)
+        step = steps.alias()
+        following = select([step.c.id, step.c.prev_step_id, (found.c.depth + literal_column("1", Integer)).label("depth")]).\
+                where(follows(step, found))
+        if max_depth is not None:
+            following = following.where(found.c.depth < literal_column("%d" % max_depth, Integer))
+        found = found.union_all(following)
+        return self.session.query(Step, found.c.depth, HistoryStep.history_id, HistoryStep.position).\
+                            join(found, Step.id == found.c.id).\
+                            outerjoin(HistoryStep, HistoryStep.step_id == Step.id).\
+                            order_by(found.c.depth, Step.created_at).\
+                            all()
+
+    def search_steps(self, user_id, contains = None, path = None, value = ANY, limit = 100):
+        """
+        Find a user's steps, newest first, whose data contains the given JSON
+        value, and/or has something at a path of keys (or array indices),
+        or something equal to the given value. Returns (step, history_id,
+        position) tuples.
+
+        On Postgresql this is done in the database, using the index on the
+        data column for containment. Delta encoded steps have no data there,
+        so they are rebuilt and scanned, as all steps are elsewhere.
+        """
+        q = self.session.query(Step, HistoryStep.history_id, HistoryStep.position).\
+                         join(HistoryStep, HistoryStep.step_id == Step.id).\
+                         join(History, History.id == HistoryStep.history_id).\
+                         filter(History.user_id == user_id)
+        newest_first = Step.created_at.desc()
+
+        if self.__engine__.dialect.name != 'postgresql':
+            return self._scan_steps(q.order_by(newest_first), contains, path, value, limit)
+
+        # Steps with data of their own, and deduplicated steps, are searched
+        # separately, so that each can use the index on its data.
+        own = self._filter_data(q.filter(Step.data != None), Step.data, contains, path, value)
+        shared = self._filter_data(q.join(Step.payload), Payload.data, contains, path, value)
+        found = own.union_all(shared).order_by(newest_first).limit(limit).all() + \
+                self._scan_steps(q.filter(Step.depth > 0).order_by(newest_first), contains, path, value, limit)
+        found.sort(key = lambda row: row[0].created_at, reverse = True)
+        return found[:limit]
+
+    def _scan_steps(self, q, contains, path, value, limit):
+        """Filter the steps a query finds by their data, one at a time."""
+        found = []
+        for row in q.options(undefer(Step.data), joinedload(Step.payload)).yield_per(100):
+            data = row[0].data
+            at_path = ANY if path is None else json_path(data, path, ANY)
+            if (contains is None or json_contains(data, contains)) and \
+                    (path is None or at_path is not ANY and (value is ANY or json_equal(at_path, value))):
+                found.append(row)
+                if len(found) == limit:
+                    break
+        return found
+
+    def _filter_data(self, q, column, contains, path, value):
+        if contains is not None:
+            q = q.filter(column.op("@>")(contains))
+        if path is not None:
+            q = q.filter(self._matches_path(column, path, value))
+        return q
+
+    def _matches_path(self, column, path, value):
+        """
+        Whether a JSONB column has something at a path (with #>, which
+        follows array indices as well as keys), or something equal to value.
+        """
+        at_path = value_at(column, path)
+        if value is ANY:
+            return at_path != None
+        return at_path == cast(json.dumps(value), JSONB())
+
+    def migrate_step_data_to_jsonb(self):
+        """
+        Convert the data column of a Postgresql database created before step
+        data was stored as JSONB, and index it. Returns whether there was
+        anything to do.
+        """
+        if self.__engine__.dialect.name != 'postgresql':
+            return False
+        column_type = self.session.execute(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = 'steps' AND column_name = 'data'").scalar()
+        if column_type == 'jsonb':
+            return False
+        self.session.execute("ALTER TABLE steps ALTER COLUMN data TYPE jsonb USING data::jsonb")
+        self.session.execute(STEP_DATA_INDEX)
+        return True
+
+    def migrate_step_deltas(self):
+        """
+        Add the columns that delta encoded steps are stored in to a database
+        created before steps could be delta encoded. Returns the names of
+        the columns that were added.
+        """
+        return self._add_missing_columns(Step.__table__, ["patch", "depth"])
+
+    def migrate_step_payloads(self):
+        """
+        Add the payloads table, and the indexed column that deduplicated
+        steps refer to their payload by, to a database created before step
+        data was deduplicated. Returns what was added.
+        """
+        created = "payloads" not in inspect(self.session.connection()).get_table_names()
+        Payload.__table__.create(self.session.connection(), checkfirst = True)
+        added = self._add_missing_columns(Step.__table__, ["payload_digest"])
+        if "payload_digest" in added and self.__engine__.dialect.name == 'postgresql':
+            self.session.execute("ALTER TABLE steps ADD FOREIGN KEY (payload_digest) REFERENCES payloads (digest)")
+        indexed = self._add_missing_indexes([Step.__table__])
+        return dict(created = created, added = added, indexed = indexed)
+
+    def migrate_histories(self):
+        """
+        Bring the history tables of a database created before steps had
+        positions, and histories forks and versions, up to date: add the
+        missing columns, number the steps of each history by following
+        their prev_step_id chain, key histories_steps on (histories_id,
+        position), and create the indexes that are missing. Returns what
+        was done.
+        """
+        histories, links = History.__table__, HistoryStep.__table__
+        added = self._add_missing_columns(links, ["position"]) + \
+                self._add_missing_columns(histories, ["parent_id", "fork_point", "version"])
+        for name in ("fork_point", "version"):
+            self.session.execute(histories.update().where(histories.c[name] == None).values({name: 0}))
+        if self.__engine__.dialect.name == 'postgresql':
+            for name in set(["fork_point", "version"]) & set(added):
+                self.session.execute("ALTER TABLE histories ALTER COLUMN %s SET NOT NULL" % (name))
+            if "parent_id" in added:
+                self.session.execute("ALTER TABLE histories ADD FOREIGN KEY (parent_id) REFERENCES histories (id)")
+        numbered = self._number_steps()
+        keyed = self._key_history_steps()
+        indexed = self._add_missing_indexes([histories, links, Step.__table__, Grant.__table__])
+        return dict(added = added, numbered = numbered, keyed = keyed, indexed = indexed)
+
+    def _number_steps(self):
+        """Fill in the positions of steps linked to histories before they had them."""
+        links, steps = HistoryStep.__table__, Step.__table__
+        unnumbered = select([links.c.histories_id]).where(links.c.position == None).distinct()
+        numbered = 0
+        for history_id, in self.session.execute(unnumbered).fetchall():
+            chain = self.session.execute(select([links.c.steps_id, steps.c.prev_step_id]).\
+                    select_from(links.join(steps, steps.c.id == links.c.steps_id)).\
+                    where(links.c.histories_id == history_id).\
+                    order_by(steps.c.created_at, steps.c.id)).fetchall()
+            update = links.update().\
+                     where(links.c.histories_id == bindparam("history", type_ = links.c.histories_id.type)).\
+                     where(links.c.steps_id == bindparam("step", type_ = links.c.steps_id.type)).\
+                     values(position = bindparam("at", type_ = Integer))
+            self.session.execute(update, [dict(history = history_id, step = step_id, at = i) \
+                    for i, step_id in enumerate(chain_order(chain))])
+            numbered += len(chain)
+        return numbered
+
+    def _key_history_steps(self):
+        """Make (histories_id, position) the primary key of histories_steps, if it is not."""
+        if inspect(self.session.connection()).get_pk_constraint("histories_steps")["constrained_columns"]:
+            return False
+        if self.__engine__.dialect.name == 'postgresql':
+            self.session.execute("ALTER TABLE histories_steps "
+                                 "ALTER COLUMN steps_id SET NOT NULL, ADD PRIMARY KEY (histories_id, position)")
+            return True
+        # Elsewhere tables cannot gain primary keys, so the table is made again.
+        self.session.execute("ALTER TABLE histories_steps RENAME TO histories_steps_unkeyed")
+        HistoryStep.__table__.create(self.session.connection())
+        self.session.execute("INSERT INTO histories_steps (histories_id, position, steps_id) "
+                             "SELECT histories_id, position, steps_id FROM histories_steps_unkeyed")
+        self.session.execute("DROP TABLE histories_steps_unkeyed")
+        return True
+
+    def _add_missing_columns(self, table, names):
+        present = set(c["name"] for c in inspect(self.session.connection()).get_columns(table.name))
+        added = [name for name in names if name not in present]
+        for name in added:
+            column_type = table.c[name].type.compile(dialect = self.__engine__.dialect)
+            self.session.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, name, column_type))
+        return added
+
+    def _add_missing_indexes(self, tables):
+        """Create those indexes of some tables that are not there, once their columns are."""
+        inspector = inspect(self.session.connection())
+        present = set(inspector.get_table_names())
+        added = []
+        for table in tables:
+            if table.name not in present:
+                continue
+            columns = set(c["name"] for c in inspector.get_columns(table.name))
+            indexes = set(i["name"] for i in inspector.get_indexes(table.name))
+            for index in sorted(table.indexes, key = lambda i: i.name):
+                if index.name not in indexes and all(c.name in columns for c in index.columns):
+                    index.create(self.session.connection())
+                    added.append(index.name)
+        return added
+
+    def migrate_token_expiry(self):
+        """
+        Give the bearer tokens of a Postgresql database created before they
+        stored their expiry an indexed expires_at column, and fill it in
+        from when they were created and how long they last, so that they
+        can be swept. Returns how many tokens were filled in.
+        """
+        if self.__engine__.dialect.name != 'postgresql':
+            return 0
+        has_column = self.session.execute(
+                "SELECT count(*) FROM information_schema.columns "
+                "WHERE table_name = 'oauth2bearertokens' AND column_name = 'expires_at'").scalar()
+        if not has_column:
+            self.session.execute("ALTER TABLE oauth2bearertokens ADD COLUMN expires_at timestamp without time zone")
+            self.session.execute("CREATE INDEX ix_oauth2bearertokens_expires_at ON oauth2bearertokens (expires_at)")
+        return self.session.execute(
+                "UPDATE oauth2bearertokens "
+                "SET expires_at = created_at + coalesce(expires_in, 3600) * interval '1 second' "
+                "WHERE expires_at IS NULL AND created_at IS NOT NULL").rowcount
+
     def fork_history(self, history, index):
         """
         Make a new history, retaining the first n steps from the old one.
+
+        The retained steps are shared with the old history rather than
+        copied, so forking writes a single row however long the history is.
         """
         h = self.session.query(History).filter_by(**select_keys(history, ["id", "name"])).one()
+        index = min(index, h.length())
         hh = h.user.new_history(h.name)
-        hh.steps = h.steps[:index]
+        if index:
+            hh.parent = h.owner_of(index - 1)
+            hh.fork_point = index
+        self.notify("history_forked", h.id, hh.id, index)
         return hh
 
     def fetch_client(self, client):
@@ -65,7 +1214,7 @@ class Store(object):
         return self.session.query(Client).filter_by(**constraint).first()
 
     def get_grant(self, client_id, code):
-        return session.query(Grant).\
+        return self.session.query(Grant).\
                        filter_by(client_id = client_id, code = code).\
                        first()
 
@@ -81,23 +1230,98 @@ class Store(object):
         return grant
 
     def get_token(self, contraint):
-        return self.query(BearerToken).filter_by(**contraint).first()
+        return self.session.query(BearerToken).\
+                            options(joinedload(BearerToken.user), joinedload(BearerToken.client)).\
+                            filter_by(**contraint).\
+                            first()
 
     def add_token(self, client, user, attrs):
-        toks = BearerToken.query.filter_by(client = client, user = user)
-        self.session.delete(toks)
-        to_store = select_keys(attrs, ["accept_token", "refresh_token", "token_type", "expires_in"])
+        toks = self.session.query(BearerToken).filter_by(client = client, user = user)
+        for tok in toks:
+            self.notify("token_revoked", tok.access_token, tok.refresh_token)
+            self.session.delete(tok)
+        to_store = select_keys(attrs, ["access_token", "refresh_token", "token_type", "expires_in"])
+        created_at = datetime.utcnow()
         to_store.update(dict(
-            scopes = token["scope"].split(),
+            scopes = attrs["scope"].split(),
             user = user,
-            client = client))
+            client = client,
+            created_at = created_at,
+            expires_at = created_at + timedelta(seconds = to_store.get("expires_in", 60 ** 2))))
         tok = BearerToken(**to_store)
         self.session.add(tok)
         return tok
 
+    def delete_expired_grants(self, now, limit):
+        """
+        Delete up to limit grants that expired before now, returning how many
+        were deleted.
+        """
+        return self._delete_batch(Grant, Grant.expires < now, limit)
+
+    def delete_expired_tokens(self, now, limit):
+        """
+        Delete up to limit bearer tokens that expired before now, returning
+        how many were deleted.
+        """
+        return self._delete_batch(BearerToken, BearerToken.expires_at < now, limit)
+
+    def delete_unreachable_steps(self, limit, after = None):
+        """
+        Delete up to limit steps that are in no history and that no other
+        step follows on from, looking at steps in id order from just after
+        the given id. Returns how many were deleted, about how many bytes
+        of data they held, and the id to carry on after, or None once the
+        last step has been looked at. Deleting a step can leave the step
+        before it unreachable in turn, to be collected in a later pass.
+        """
+        following = Step.__table__.alias()
+        unreachable = and_(~exists().where(HistoryStep.step_id == Step.id),
+                           ~exists().where(following.c.prev_step_id == Step.id))
+        size = func.coalesce(func.length(cast(Step.stored_data, Text)), 0) + \
+               func.coalesce(func.length(cast(Step.patch, Text)), 0)
+        q = self.session.query(Step.id, size).filter(unreachable)
+        if after is not None:
+            q = q.filter(Step.id > after)
+        batch = q.order_by(Step.id).limit(limit).all()
+        if not batch:
+            return 0, 0, None
+        # Check again, in case anything has been added since.
+        deleted = self.session.execute(Step.__table__.delete().\
+                where(and_(Step.id.in_([step_id for step_id, _ in batch]), unreachable))).rowcount
+        if deleted:
+            self.notify("steps_deleted", deleted)
+        return deleted, sum(n for _, n in batch), batch[-1][0] if len(batch) == limit else None
+
+    def delete_unused_payloads(self, before, limit):
+        """
+        Delete up to limit payloads that were stored before the given time
+        and that no step refers to, returning how many were deleted. On
+        Postgresql those locked by appends that reuse them are skipped.
+        """
+        if self.__engine__.dialect.name == 'postgresql':
+            return self.session.execute(PAYLOAD_SWEEP, dict(before = before, limit = limit)).rowcount
+        unused = ~exists().where(Step.payload_digest == Payload.digest)
+        return self._delete_batch(Payload, and_(Payload.created_at < before, unused), limit, Payload.digest)
+
+    def _delete_batch(self, model, condition, limit, key = None):
+        key = model.id if key is None else key
+        batch = select([key]).where(condition).limit(limit)
+        return self.session.execute(model.__table__.delete().where(key.in_(batch))).rowcount
+
+    def detach(self, *objs):
+        """
+        Remove objects from the session, so that they can outlive it, eg. in
+        a cache. Anything they refer to must already be loaded.
+        """
+        for obj in objs:
+            if obj is not None:
+                self.session.expunge(obj)
+
     def close(self):
         if self._session is not None: self._session.close()
         self._session = None
+        self._events = []
 
     def __enter__(self):
         self.close() # Start with new session
@@ -106,7 +1330,12 @@ class Store(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type or exc_val:
             self.session.rollback()
+            self._events = []
+            self._wrote = False
         else:
+            self._broadcast()
             self.session.commit()
+            self.committed = self.committed or self._wrote
+            self._publish()
         return False
 
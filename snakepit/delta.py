@@ -0,0 +1,72 @@
+"""
+Delta encoding of step data.
+
+A step can be stored as a JSON patch (RFC 6902, using only the add, remove
+and replace operations) against the data of its previous step, instead of
+as a full copy. Every so often a step is stored in full again, as a
+keyframe, so that rebuilding a step never takes more than a few patches.
+"""
+import json
+from collections import Mapping
+
+from cache import LRUCache
+from sqltypes import LazyJSON
+from utils import parse_pointer, is_array
+
+# The JSON text of keyframes and rebuilt steps, by step id. Steps never
+# change, so these never need invalidating.
+frames = LRUCache(max_size = 10000, max_weight = 64 * 1024 * 1024)
+
+def plain(value):
+    """A mutable copy of a JSON value, eg. as loaded from the database."""
+    if isinstance(value, LazyJSON):
+        return json.loads(value.raw)
+    return json.loads(json.dumps(value, default = dict))
+
+def escape(key):
+    return key.replace("~", "~0").replace("/", "~1")
+
+def diff(old, new, path = ""):
+    """The operations that turn one JSON value into another."""
+    if isinstance(old, Mapping) and isinstance(new, Mapping):
+        ops = [{"op": "remove", "path": path + "/" + escape(k)} for k in old if k not in new]
+        for k, v in new.iteritems():
+            p = path + "/" + escape(k)
+            if k in old:
+                ops.extend(diff(old[k], v, p))
+            else:
+                ops.append({"op": "add", "path": p, "value": v})
+        return ops
+    if is_array(old) and is_array(new):
+        ops = []
+        for i in range(min(len(old), len(new))):
+            ops.extend(diff(old[i], new[i], "%s/%d" % (path, i)))
+        for i in range(len(old), len(new)):
+            ops.append({"op": "add", "path": "%s/%d" % (path, i), "value": new[i]})
+        for i in reversed(range(len(new), len(old))):
+            ops.append({"op": "remove", "path": "%s/%d" % (path, i)})
+        return ops
+    if type(old) == type(new) and old == new:
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+def apply_patch(doc, ops):
+    """Apply operations from diff to a mutable JSON value, returning it."""
+    for op in ops:
+        keys = parse_pointer(op["path"])
+        if not keys:
+            doc = op["value"]
+            continue
+        parent = doc
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        key = keys[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == "-" else int(key)
+        if op["op"] == "remove":
+            del parent[key]
+        elif op["op"] == "add" and isinstance(parent, list):
+            parent.insert(key, op["value"])
+        else:
+            parent[key] = op["value"]
+    return doc
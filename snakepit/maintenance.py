@@ -0,0 +1,159 @@
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+
+import data
+import transfer
+from utils import setting
+
+log = logging.getLogger(__name__)
+
+def sweep_expired(store, batch_size = 1000):
+    """
+    Delete expired OAuth grants and bearer tokens, a batch at a time, with
+    each batch in its own short transaction so that no locks are held for
+    long. Returns the number of rows deleted and the time taken for each.
+
+    Tokens from before bearer tokens stored their expiry are only swept
+    once it has been filled in (see Store.migrate_token_expiry).
+    """
+    now = datetime.utcnow()
+    return {
+        "grants": _sweep(store, store.delete_expired_grants, now, batch_size),
+        "tokens": _sweep(store, store.delete_expired_tokens, now, batch_size)
+    }
+
+def sweep_payloads(store, batch_size = 1000, grace = 3600):
+    """
+    Delete the deduplicated step payloads that no step refers to. Payloads
+    stored in the last grace seconds are kept, as the steps that refer to
+    them may not have been committed yet.
+    """
+    before = datetime.now() - timedelta(seconds = grace)
+    return {"payloads": _sweep(store, store.delete_unused_payloads, before, batch_size)}
+
+def collect_garbage(store, batch_size = 1000, max_batches = None, pause = 0):
+    """
+    Delete the steps that can no longer be reached from any history, a
+    batch at a time, pausing between batches so as not to crowd out other
+    work. Each pass goes through the steps once, in id order; another pass
+    follows if the last one deleted anything, as that can leave the steps
+    before those unreachable. Stops when a pass deletes nothing, or after
+    max_batches.
+    """
+    start, deleted, reclaimed, batches = time.time(), 0, 0, 0
+    complete, after, deleted_in_pass = False, None, 0
+    while max_batches is None or batches < max_batches:
+        with store:
+            n, size, after = store.delete_unreachable_steps(batch_size, after)
+        deleted += n
+        reclaimed += size
+        batches += 1
+        deleted_in_pass += n
+        if after is None:
+            if deleted_in_pass == 0:
+                complete = True
+                break
+            deleted_in_pass = 0
+        time.sleep(pause)
+    return {"steps": dict(deleted = deleted, bytes = reclaimed, batches = batches,
+                          complete = complete, seconds = time.time() - start)}
+
+def rebalance(config, limit = None, wait = None, batch_size = 1000):
+    """
+    Move users whose histories are not on the shard the ring now gives
+    them (eg. after a shard is added, or one is being drained, or they are
+    still in the main database from before histories were sharded) onto
+    it, one user at a time, while the application keeps running. Returns
+    how many users and records were moved.
+    """
+    wait = setting(config, "SHARD_PLACEMENT_TTL", 5, float) if wait is None else wait
+    start, users, counts = time.time(), 0, dict(history = 0, step = 0, link = 0)
+    with data.Store(config) as directory:
+        directory.place_unsharded_users()
+    with data.Store(config) as directory:
+        misplaced = directory.misplaced_users(limit)
+    for user_id, shard, owner in misplaced:
+        moved = move_user(config, user_id, shard, owner, wait, batch_size)
+        users += 1
+        for kind, n in moved.items():
+            counts[kind] += n
+    counts.update(users = users, seconds = time.time() - start)
+    return {"moved": counts}
+
+def move_user(config, user_id, source, target, wait, batch_size = 1000):
+    """
+    Move a user's histories and steps from one shard to another, by
+    exporting them from one and importing them into the other.
+
+    Changes to the user's histories are refused while they are moving. We
+    wait for as long as other processes may have their placement cached
+    after marking them as moving (so that no more changes are under way)
+    and again after placing them on the target (so that nothing still
+    reads from the source) before deleting them from the source.
+    """
+    with data.Store(config) as directory:
+        user = directory.fetch_user(id = user_id)
+        directory.detach(user)
+        directory.set_placement(user_id, source, moving = True)
+    data.placements.discard(str(user_id))
+    try:
+        time.sleep(wait)
+        exporting = data.Store(config, shard = source)
+        try:
+            with data.Store(config, shard = target) as importing:
+                importing.copy_user(user)
+                lines = transfer.export_lines(exporting, user_id, batch_size)
+                counts = importing.import_histories(user_id, transfer.read_lines(lines), batch_size)
+        finally:
+            exporting.close()
+    except Exception:
+        with data.Store(config) as directory:
+            directory.set_placement(user_id, source)
+        data.placements.discard(str(user_id))
+        raise
+    with data.Store(config) as directory:
+        directory.set_placement(user_id, target)
+    data.placements.discard(str(user_id))
+    time.sleep(wait)
+    with data.Store(config, shard = source) as old:
+        old.delete_histories(user_id)
+    log.info("Moved user %s from shard %s to %s: %r", user_id, source, target, counts)
+    return counts
+
+def _sweep(store, delete_batch, before, batch_size):
+    start, deleted, batches = time.time(), 0, 0
+    while True:
+        with store:
+            n = delete_batch(before, batch_size)
+        deleted += n
+        batches += 1
+        if n < batch_size:
+            break
+    return dict(deleted = deleted, batches = batches, seconds = time.time() - start)
+
+class PeriodicJob(threading.Thread):
+    """
+    Runs a job every interval seconds in a daemon thread, until stopped.
+    The report returned by the latest run is kept in last_report.
+    """
+
+    def __init__(self, name, interval, job):
+        super(PeriodicJob, self).__init__(name = name)
+        self.daemon = True
+        self.interval = interval
+        self.job = job
+        self.last_report = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.last_report = self.job()
+                log.info("%s: %r", self.name, self.last_report)
+            except Exception:
+                log.exception("%s failed", self.name)
+
+    def stop(self):
+        self._stopped.set()
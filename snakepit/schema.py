@@ -1,11 +1,18 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Unicode, Boolean, UnicodeText
+from sqlalchemy import Table, Column, Index, Integer, String, DateTime, ForeignKey, Unicode, Boolean, UnicodeText, DDL, event, func, \
+        select, literal_column, cast, Text
 from sqlalchemy.dialects.postgresql import ARRAY
-from sqlalchemy.orm import relationship, backref, deferred
+from sqlalchemy import inspect
+from sqlalchemy.orm import relationship, backref, deferred, object_session
+from sqlalchemy.ext.hybrid import hybrid_property
 from uuid import uuid4
 import datetime
+import hashlib
+import json
 
-from sqltypes import GUID, JSONEncodedValue
+from sqltypes import GUID, JSONEncodedValue, lazy_json
+import compression
+import delta
 from security import hash_pw
 
 Base = declarative_base()
@@ -15,9 +22,12 @@ user_role_assoc_table = Table('users_roles', Base.metadata,
         Column('users_id', GUID, ForeignKey('users.id')),
         Column('roles_id', Integer, ForeignKey('roles.id')))
 
+# Steps are addressed by their position in a history, so the
+# (histories_id, position) primary key doubles as the lookup index.
 history_steps_assoc_table = Table('histories_steps', Base.metadata,
-        Column('histories_id', GUID, ForeignKey('histories.id')),
-        Column('steps_id', GUID, ForeignKey('steps.id')))
+        Column('histories_id', GUID, ForeignKey('histories.id'), primary_key = True),
+        Column('position', Integer, primary_key = True, autoincrement = False),
+        Column('steps_id', GUID, ForeignKey('steps.id'), nullable = False, index = True))
 
 class User(Base):
     __tablename__ = 'users'
@@ -50,18 +60,54 @@ class Role(Base):
     id = Column(Integer, primary_key = True)
     name = Column(String(50), unique = True)
 
+class UserShard(Base):
+    """
+    The shard that holds a user's histories, when they are sharded (see
+    data.shard_of). Kept in the main database, with the users.
+    """
+    __tablename__ = 'user_shards'
+
+    user_id = Column(GUID, ForeignKey('users.id'), primary_key = True)
+    shard = Column(String(50), nullable = False, index = True)
+    moving = Column(Boolean, nullable = False, default = False)
+
+class Payload(Base):
+    """Step data, stored once under its digest however many steps share it."""
+    __tablename__ = 'payloads'
+
+    digest = Column(String(64), primary_key = True)
+    data = Column(JSONEncodedValue)
+    created_at = Column(DateTime(timezone = True), default = datetime.datetime.now, index = True)
+
+    @staticmethod
+    def encode(value):
+        """The canonical JSON text of a value, and its digest."""
+        text = json.dumps(delta.plain(value), sort_keys = True, separators = (',', ':'))
+        return text, hashlib.sha256(text.encode('utf-8')).hexdigest()
+
 class Step(Base):
     __tablename__ = 'steps'
 
     id = Column(GUID, primary_key = True, default = uuid4)
     created_at = Column(DateTime(timezone = True), default = datetime.datetime.now)
     mimetype = Column(String)
-    data = deferred(Column(JSONEncodedValue))
+    stored_data = deferred(Column("data", JSONEncodedValue))
     tool = Column(String(255))
 
-    prev_step_id = Column(GUID, ForeignKey('steps.id'), nullable = True)
+    # Delta encoded steps store a patch against their previous step instead
+    # of their data, and are this many patches away from a keyframe.
+    patch = deferred(Column(JSONEncodedValue))
+    depth = Column(Integer, default = 0)
 
-    previous_step = relationship("Step", uselist = False, backref = backref("next_steps", uselist=True, remote_side = [id], order_by = created_at))
+    # Deduplicated steps refer to their data by its digest.
+    payload_digest = Column(String(64), ForeignKey('payloads.digest'), nullable = True, index = True)
+    payload = relationship(Payload)
+
+    prev_step_id = Column(GUID, ForeignKey('steps.id'), nullable = True, index = True)
+
+    previous_step = relationship("Step", uselist = False, remote_side = [id], backref = backref("next_steps", uselist=True, order_by = created_at))
+
+    _loaded = None
 
     def __init__(self, tool, mimetype, data, id = None):
         self.id = (id or uuid4())
@@ -69,35 +115,239 @@ class Step(Base):
         self.mimetype = mimetype
         self.data = data
 
+    @hybrid_property
+    def data(self):
+        if self._loaded is None:
+            if self.depth:
+                self._loaded = lazy_json(self._rebuild())
+            elif self.payload_digest is not None:
+                self._loaded = self.payload.data
+            else:
+                return self.stored_data
+        return self._loaded
+
+    @data.setter
+    def data(self, value):
+        self.stored_data = value
+
+    @data.expression
+    def data(cls):
+        return cls.stored_data
+
+    def store_delta(self, ops, depth):
+        """Store this step as a patch against its previous step."""
+        self._loaded = self.data
+        self.patch = ops
+        self.depth = depth
+        self.stored_data = None
+
+    def store_payload(self, digest, payload = None):
+        """Store this step's data as the payload with the given digest."""
+        self._loaded = self.data
+        self.payload_digest = digest
+        if payload is not None:
+            self.payload = payload
+        self.stored_data = None
+
+    def _rebuild(self):
+        """
+        Apply the patches between this step and its keyframe, starting
+        from the nearest step on the way whose data is already known.
+        """
+        steps = Step.__table__
+        found = select([steps.c.id, steps.c.prev_step_id, literal_column("0", Integer).label("depth")]).\
+                where(steps.c.id == self.id).\
+                cte("found", recursive = True)
+        step = steps.alias()
+        found = found.union_all(
+                select([step.c.id, step.c.prev_step_id, (found.c.depth + literal_column("1", Integer)).label("depth")]).\
+                where(step.c.id == found.c.prev_step_id).\
+                where(found.c.depth < literal_column("%d" % self.depth, Integer)))
+        session = object_session(self)
+        chain = session.query(Step.id, Step.patch).\
+                        join(found, Step.id == found.c.id).\
+                        order_by(found.c.depth).\
+                        all()
+        patches = []
+        for step_id, patch in chain:
+            text = delta.frames.get(step_id)
+            if text is not None:
+                break
+            if patch is None:
+                stored, payload = session.query(cast(Step.stored_data, Text), cast(Payload.data, Text)).\
+                                          outerjoin(Step.payload).\
+                                          filter(Step.id == step_id).\
+                                          one()
+                text = compression.text_of(payload if stored is None else stored)
+                delta.frames.put(step_id, text)
+                break
+            patches.append(patch)
+        doc = json.loads(text)
+        for patch in reversed(patches):
+            doc = delta.apply_patch(doc, delta.plain(patch))
+        text = json.dumps(doc)
+        delta.frames.put(self.id, text)
+        return text
+
+# On Postgresql step data is JSONB, indexed for containment (@>) queries.
+STEP_DATA_INDEX = DDL("CREATE INDEX ix_steps_data ON steps USING gin (data jsonb_path_ops)")
+event.listen(Step.__table__, "after_create", STEP_DATA_INDEX.execute_if(dialect = 'postgresql'))
+PAYLOAD_DATA_INDEX = DDL("CREATE INDEX ix_payloads_data ON payloads USING gin (data jsonb_path_ops)")
+event.listen(Payload.__table__, "after_create", PAYLOAD_DATA_INDEX.execute_if(dialect = 'postgresql'))
+
+class HistoryStep(Base):
+    """The place of a step in a history."""
+    __table__ = history_steps_assoc_table
+
+    history_id = history_steps_assoc_table.c.histories_id
+    step_id = history_steps_assoc_table.c.steps_id
+
+    step = relationship(Step, lazy = "joined")
+
+    def __repr__(self):
+        return "<HistoryStep(%r, %r)>" % (self.history_id, self.position)
 
 class History(Base):
+    """
+    An ordered sequence of steps.
+
+    A fork shares the first fork_point steps of its parent rather than
+    copying them, and only stores the steps appended after the fork, at
+    positions fork_point onwards.
+
+    Appending to a history bumps its version, if it is still the version
+    that was loaded (see claim), so that concurrent appenders find out
+    about each other instead of writing at the same position.
+    """
     __tablename__ = 'histories'
+    __table_args__ = (Index('ix_histories_user_created', 'user_id', 'created_at', 'id'),)
 
     id = Column(GUID, primary_key = True, default = uuid4)
     name = Column(String)
     created_at = Column(DateTime(timezone = True), default = datetime.datetime.now)
     user_id = Column(GUID, ForeignKey('users.id'))
+    parent_id = Column(GUID, ForeignKey('histories.id'), nullable = True)
+    fork_point = Column(Integer, nullable = False, default = 0)
+    version = Column(Integer, nullable = False, default = 0)
+
+    __mapper_args__ = {"version_id_col": version}
 
     user = relationship(User, backref = backref('histories', order_by=created_at))
-    steps = relationship(Step, secondary = history_steps_assoc_table)
+    parent = relationship("History", remote_side = [id])
+    links = relationship(HistoryStep, backref = "history",
+            order_by = HistoryStep.position, cascade = "all, delete-orphan")
 
     def __init__(self, name, **kwargs):
         self.id = kwargs.get("id", uuid4())
         if "created_at" in kwargs:
             self.created_at = kwargs.get("created_at")
         self.name = name
+        self.parent = kwargs.get("parent")
+        self.fork_point = kwargs.get("fork_point", 0)
 
     def __repr__(self):
         return "<History(%r, %r)>" % (self.id, self.name)
 
+    @property
+    def steps(self):
+        """
+        All the steps in this history, in order. This loads the whole
+        history, so prefer length and step_at where that is not needed.
+        """
+        steps, limit, h = [], None, self
+        while h is not None:
+            steps[:0] = [link.step for link in h.links \
+                    if limit is None or link.position < limit]
+            limit, h = h.fork_point, h.parent
+        return steps
+
+    def steps_between(self, start, stop):
+        """
+        The (position, step) pairs of this history from start up to (but
+        not including) stop, each looked up in the history that owns it.
+        """
+        session = object_session(self)
+        if session is None:
+            return [(i, s) for i, s in enumerate(self.steps) if start <= i < stop]
+        found, h = [], self
+        while h is not None and start < stop:
+            lower = max(start, h.fork_point)
+            if lower < stop:
+                links = session.query(HistoryStep).\
+                                filter(HistoryStep.history_id == h.id).\
+                                filter(HistoryStep.position >= lower).\
+                                filter(HistoryStep.position < stop).\
+                                order_by(HistoryStep.position)
+                found[:0] = [(link.position, link.step) for link in links]
+            stop = min(stop, h.fork_point)
+            h = h.parent
+        return found
+
+    def owner_of(self, idx):
+        """
+        The history (this one or one of its ancestors) that holds the step
+        at the given position.
+        """
+        h = self
+        while h is not None and idx < h.fork_point:
+            h = h.parent
+        return h
+
+    def length(self):
+        """
+        The number of steps in this history.
+        """
+        session = object_session(self)
+        if session is None:
+            return self.links[-1].position + 1 if self.links else self.fork_point
+        last = session.query(func.max(HistoryStep.position)).\
+                       filter(HistoryStep.history_id == self.id).\
+                       scalar()
+        return self.fork_point if last is None else last + 1
+
+    def step_at(self, idx):
+        """
+        The step at the given position in this history, or None.
+        """
+        if idx < 0:
+            return None
+        owner = self.owner_of(idx)
+        session = object_session(self)
+        if session is None:
+            found = [l.step for l in owner.links if l.position == idx]
+            return found[0] if found else None
+        return session.query(Step).join(HistoryStep).\
+                       filter(HistoryStep.history_id == owner.id).\
+                       filter(HistoryStep.position == idx).\
+                       first()
+
+    def claim(self):
+        """
+        Bump this history's version, so that when it is flushed (as late as
+        possible, usually on commit) the update checks that nothing has been
+        appended to it since it was loaded. If something has, the flush
+        raises HistoryConflict (see data.StoreSession).
+        """
+        session = object_session(self)
+        if session is not None and inspect(self).persistent:
+            self.version = self.version + 1
+
     def append_step(self, tool, mimetype, data):
+        position = self.length()
         s = Step(tool = tool, mimetype = mimetype, data = data)
-        if len(self.steps):
-            s.previous_step = self.steps[-1]
-
-        self.steps.append(s)
+        if position:
+            s.previous_step = self.step_at(position - 1)
+
+        link = HistoryStep(history = self, position = position, step = s)
+        session = object_session(self)
+        if session is not None:
+            session.add(link)
+        self.claim()
         return s
 
+class HistoryConflict(Exception):
+    """Something else appended to a history since it was loaded."""
+
 class Client(Base):
     __tablename__ = "oauth2clients"
 
@@ -133,7 +383,7 @@ class Grant(Base):
     client = relationship('Client')
     code = Column(Unicode(255), index = True, nullable = False)
     redirect_uri = Column(Unicode(255))
-    expires = Column(DateTime)
+    expires = Column(DateTime, index = True)
     scopes = Column(ARRAY(Unicode(255), as_tuple = True))
 
 class BearerToken(Base):
@@ -149,9 +399,12 @@ class BearerToken(Base):
     refresh_token = Column(Unicode(255), unique=True)
     expires_in = Column(Integer, default = (60 ** 2))
     created_at = Column(DateTime, default = datetime.datetime.utcnow)
+    expires_at = Column(DateTime, index = True)
     scopes = Column(ARRAY(Unicode(255)))
 
     @property
     def expires(self):
+        if self.expires_at is not None:
+            return self.expires_at
         return self.created_at + datetime.timedelta(seconds = self.expires_in)
 
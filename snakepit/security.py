@@ -1,29 +1,106 @@
 from functools import wraps
 from flask import g, session
+import multiprocessing
+import os
+import threading
 import bcrypt
+from cache import LRUCache
+from utils import setting
+
+class PasswordHasher(object):
+    """
+    Hashes and checks passwords with bcrypt in a pool of worker processes,
+    so that the cost of a hash is not paid by the thread serving the
+    request. At most max_concurrent hashes are in flight at once, and
+    other callers wait for a free slot. With processes = 0 passwords are
+    hashed in the calling thread.
+    """
+
+    def __init__(self, rounds = 12, processes = None, max_concurrent = None):
+        self.rounds = rounds
+        self.processes = processes
+        if max_concurrent is None:
+            max_concurrent = processes or multiprocessing.cpu_count()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._inherited_pools = []
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                # A pool inherited from a parent process belongs to it, and
+                # finalizing it here would terminate the parent's workers.
+                if self._pool is not None:
+                    self._inherited_pools.append(self._pool)
+                self._pool = multiprocessing.Pool(self.processes)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _hashpw(self, password, salt):
+        if self.processes == 0:
+            return bcrypt.hashpw(password, salt)
+        with self._slots:
+            return self._get_pool().apply_async(bcrypt.hashpw, (password, salt)).get()
+
+    def hash(self, password):
+        return self._hashpw(str(password), bcrypt.gensalt(self.rounds))
+
+    def check(self, password, hashed):
+        return self._hashpw(str(password), str(hashed)) == hashed
+
+    def needs_rehash(self, hashed):
+        """Whether a hash was made with a different cost to the configured one."""
+        return int(str(hashed).split("$")[2]) != self.rounds
+
+hasher = PasswordHasher()
+
+def configure_hashing(config):
+    global hasher
+    hasher = PasswordHasher(
+        rounds = setting(config, "BCRYPT_ROUNDS", 12),
+        processes = setting(config, "BCRYPT_PROCESSES", None),
+        max_concurrent = setting(config, "BCRYPT_MAX_CONCURRENT", None))
 
 def hash_pw(password):
-    return bcrypt.hashpw(str(password), bcrypt.gensalt())
+    return hasher.hash(password)
 
 def test_pw(password, hashed):
-    return bcrypt.hashpw(str(password), str(hashed)) == hashed
+    return hasher.check(password, hashed)
+
+def needs_rehash(hashed):
+    return hasher.needs_rehash(hashed)
 
 class Authenticator(object):
+    """
+    Checks the roles of the current user. Roles are cached by user id, so
+    call forget_user whenever a user's roles change.
+    """
 
-    def __init__(self, connector, on_fail):
+    def __init__(self, connector, on_fail, role_cache = None):
         self.connect = connector
         self.on_fail = on_fail
+        self.role_cache = LRUCache(ttl = 300) if role_cache is None else role_cache
+
+    def forget_user(self, user_id):
+        self.role_cache.discard(str(user_id))
 
     def get_current_user_roles(self):
-        if not "user" in session:
+        if not session.get("user"):
             return set(["anon"])
+        user_id = str(session["user"]["id"])
+        roles = self.role_cache.get(user_id)
+        if roles is not None:
+            return roles
         with self.connect() as store:
             u = store.fetch_user(**session["user"])
             if not u:
                 session["user"] = None
                 return set(["anon"])
-            roles = set(str(role.name) for role in u.roles)
-            return roles
+            roles = frozenset(str(role.name) for role in u.roles)
+        self.role_cache.put(user_id, roles)
+        return roles
 
     def requires_roles(self, *roles):
         roles = set(roles)
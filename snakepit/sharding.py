@@ -0,0 +1,30 @@
+"""
+Consistent hashing, for placing users' histories on database shards.
+
+Each shard is put at many points around a ring of hash values, and a key
+belongs to the first shard point at or after its own hash. Adding a shard
+only takes keys from the others (about 1/n of them), and removing one only
+hands its keys out, so that few users ever need to move.
+"""
+import bisect
+import hashlib
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas = 100):
+        self.nodes = sorted(nodes)
+        points = sorted((position("%s#%d" % (node, i)), node) \
+                for node in self.nodes for i in range(replicas))
+        self._positions = [p for p, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        if not self._owners:
+            raise ValueError("There are no nodes")
+        i = bisect.bisect_left(self._positions, position(key))
+        return self._owners[i % len(self._owners)]
+
+def position(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
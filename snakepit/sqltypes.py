@@ -1,9 +1,12 @@
 import collections
-from sqlalchemy.types import TypeDecorator, CHAR, Text
+from sqlalchemy import cast
+from sqlalchemy.types import TypeDecorator, UserDefinedType, CHAR, Text
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 import json
 
+import compression
+
 class GUID(TypeDecorator):
     """Platform-independent GUID type.
 
@@ -63,9 +66,144 @@ class FrozenDict(collections.Mapping):
                 self._hash ^= hash(pair)
         return self._hash
 
+class FrozenList(list):
+    "Immutable list, which still compares equal to lists"
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s is immutable" % (type(self).__name__))
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+class LazyJSON(object):
+    """A read-only JSON document, decoded on first access.
+
+    Keeps the form it was stored in (which may be compressed, see the
+    compression module), so that it can be stored or sent on again as it
+    is. Objects and arrays are represented by the JSONObject and JSONArray
+    subclasses, which act as Mappings and Sequences respectively.
+
+    """
+    __slots__ = ('stored', '_value', '_hash')
+
+    def __init__(self, stored):
+        self.stored = stored
+        self._value = self._hash = None
+
+    @property
+    def raw(self):
+        """The JSON text."""
+        return compression.text_of(self.stored)
+
+    @property
+    def codec(self):
+        """What the stored form is compressed with, if anything."""
+        return compression.codec_of(self.stored)
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = freeze(json.loads(self.raw))
+        return self._value
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            return self.stored == other.stored or self.value == other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # Equal documents may be encoded differently, so hash a canonical form.
+        if self._hash is None:
+            self._hash = hash(json.dumps(self.value, sort_keys = True, default = dict))
+        return self._hash
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __reduce__(self):
+        return (type(self), (self.stored,))
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.stored[:100])
+
+class LazyContainer(LazyJSON):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __contains__(self, key):
+        return key in self.value
+
+class JSONObject(LazyContainer):
+    __slots__ = ()
+
+class JSONArray(LazyContainer):
+    __slots__ = ()
+
+collections.Mapping.register(JSONObject)
+collections.Sequence.register(JSONArray)
+
+def freeze(value):
+    """A read-only copy of a decoded JSON value, all the way down."""
+    if isinstance(value, FrozenList):
+        return value
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    return value
+
+def lazy_json(stored):
+    """Wrap a stored document, decoding it now only if it is a scalar."""
+    start = compression.peek(stored).lstrip()[:1]
+    if start == '{':
+        return JSONObject(stored)
+    if start == '[':
+        return JSONArray(stored)
+    return json.loads(compression.text_of(stored))
+
+class JSONB(UserDefinedType):
+    """Postgresql's binary JSON type, which SQLAlchemy 0.8 does not provide."""
+
+    def get_col_spec(self):
+        return "JSONB"
+
+class JSONText(TypeDecorator):
+    """JSON values read back as text, to be decoded lazily."""
+
+    impl = Text
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = lazy_json(value)
+
+        return value
+
 class JSONEncodedValue(TypeDecorator):
     """Represents an immutable structure as a json-encoded string.
 
+    Uses Postgresql's JSONB type, so that values can be indexed and
+    queried in the database, otherwise uses Text. Either way values are
+    read back as text, and only decoded when they are used (see LazyJSON).
+
     Usage::
 
         JSONEncodedDict(255)
@@ -74,18 +212,33 @@ class JSONEncodedValue(TypeDecorator):
 
     impl = Text
 
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(JSONB())
+        else:
+            return dialect.type_descriptor(Text())
+
+    def column_expression(self, colexpr):
+        # Stop drivers from decoding JSONB themselves.
+        return cast(colexpr, JSONText)
+
     def process_bind_param(self, value, dialect):
-        if value is not None:
+        if value is None:
+            return value
+        if isinstance(value, LazyJSON):
+            if dialect.name == 'postgresql':
+                return value.raw
+            elif value.codec is not None:
+                return value.stored
+            value = value.raw
+        else:
             value = json.dumps(value)
-
-        return value
+        # Postgresql compresses large JSONB values itself.
+        return value if dialect.name == 'postgresql' else compression.pack(value)
 
     def process_result_value(self, value, dialect):
-        if value is not None:
-            jval = json.loads(value)
-            try:
-                value = FrozenDict(**jval)
-            except TypeError:
-                value = tuple(jval)
+        # Values are normally read as JSONText, unless selected some other way.
+        if isinstance(value, basestring):
+            value = lazy_json(value)
 
-        return value
+        return freeze(value)
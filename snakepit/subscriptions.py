@@ -0,0 +1,180 @@
+"""
+Subscriptions to changes in histories, for clients that would otherwise
+have to poll them.
+
+Changes come from Stores as they are committed. On Postgresql they are
+sent as notifications, which a thread in each process listens for, so that
+every process hears about every change. Elsewhere they are heard through
+data.listen, which only hears about changes made in this process.
+"""
+from collections import defaultdict
+from functools import partial
+from uuid import UUID
+import Queue
+import json
+import logging
+import select
+import threading
+
+import data
+
+log = logging.getLogger(__name__)
+
+class Hub(object):
+    """
+    Passes the changes to each history on to its subscribers. Idle
+    subscribers cost a queue each, so one process can have many.
+    """
+
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, history_id):
+        subscription = Subscription(self, history_key(history_id))
+        with self._lock:
+            self._subscriptions[subscription.history_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.history_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.history_id, None)
+
+    def publish(self, event_name, history_id, *args):
+        """
+        Pass on an event (see data.listen): either ("steps", start, end), or
+        ("fork", fork_id, fork_point).
+        """
+        if event_name == "steps_added":
+            change = ("steps",) + args
+        elif event_name == "history_forked":
+            change = ("fork", str(args[0]), args[1])
+        else:
+            return
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(history_key(history_id), ()))
+            self.published += 1
+            self.delivered += len(subscriptions)
+        for subscription in subscriptions:
+            subscription.queue.put(change)
+
+    def statistics(self):
+        with self._lock:
+            return dict(histories = len(self._subscriptions),
+                    subscribers = sum(len(s) for s in self._subscriptions.values()),
+                    published = self.published,
+                    delivered = self.delivered)
+
+class Subscription(object):
+    """The changes to a history, as they happen, until closed."""
+
+    def __init__(self, hub, history_id):
+        self.hub = hub
+        self.history_id = history_id
+        self.queue = Queue.Queue()
+
+    def get(self, timeout = None):
+        """The next change, or None if there is none within timeout seconds."""
+        try:
+            return self.queue.get(timeout = timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+def history_key(history_id):
+    return str(UUID(str(history_id)))
+
+def feed(hub, config):
+    """
+    Start publishing the changes made to every database that holds
+    histories on the hub: by listening for notifications if they are on
+    Postgresql, or otherwise for the changes made in this process.
+
+    Returns the Feed, which stops when closed.
+    """
+    engines = []
+    for shard, store in data.history_stores(config):
+        engines.append(store.__engine__)
+        store.close()
+    started = Feed([NotificationListener(engine, hub) for engine in engines \
+            if engine.dialect.name == 'postgresql'])
+    if not started.listeners:
+        for event_name in data.BROADCAST_EVENTS:
+            handler = partial(hub.publish, event_name)
+            data.listen(event_name, handler)
+            started.handlers.append((event_name, handler))
+    for listener in started.listeners:
+        listener.start()
+    return started
+
+class Feed(object):
+    """The notification listeners, or data.listen handlers, that feed a hub."""
+
+    def __init__(self, listeners):
+        self.listeners = listeners
+        self.handlers = []
+
+    def wait_ready(self, timeout = None):
+        """Whether every listener is listening, waiting up to timeout seconds for each."""
+        return all(listener.ready.wait(timeout) for listener in self.listeners)
+
+    def close(self):
+        for event_name, handler in self.handlers:
+            data.unlisten(event_name, handler)
+        self.handlers = []
+        for listener in self.listeners:
+            listener.stop()
+
+class NotificationListener(threading.Thread):
+    """
+    Publishes the history events notified on a Postgresql database on a
+    hub, using a connection of its own, from a daemon thread.
+    """
+
+    def __init__(self, engine, hub, timeout = 60, reconnect = 5):
+        super(NotificationListener, self).__init__(name = "notifications")
+        self.daemon = True
+        self.engine = engine
+        self.hub = hub
+        self.timeout = timeout
+        self.reconnect = reconnect
+        # Set once notifications are being listened for.
+        self.ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop listening, within timeout seconds."""
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.listen()
+            except Exception:
+                log.exception("Lost the connection listening for notifications")
+                self._stopped.wait(self.reconnect)
+
+    def listen(self):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute("LISTEN %s" % (data.CHANNEL))
+            self.ready.set()
+            while not self._stopped.is_set():
+                if select.select([dbapi_connection], [], [], self.timeout) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    self.hub.publish(*json.loads(notification.payload))
+        finally:
+            # Autocommit and LISTEN stay with the connection, so it must not go back to the pool.
+            connection.invalidate()
@@ -0,0 +1,52 @@
+"""
+Export and import of a user's histories as newline delimited JSON, eg:
+
+    {"type": "history", "id": "...", "name": "...", "created_at": "...", "parent_id": null, "fork_point": 0}
+    {"type": "step", "id": "...", "created_at": "...", "tool": "...", "mimetype": "...", "prev_step_id": null, "data": ...}
+    {"type": "link", "history_id": "...", "position": 0, "step_id": "..."}
+
+Histories come first, then steps (each after the step before it), then the
+places of the steps in the histories, so that a file can be imported in
+order, in a single pass.
+"""
+import json
+
+from sqltypes import LazyJSON
+
+RECORD_TYPES = ("history", "step", "link")
+
+def export_lines(store, user_id, batch_size = 1000):
+    """Stream a user's histories as lines of JSON."""
+    for kind, obj in store.export_histories(user_id, batch_size):
+        if kind == "history":
+            yield record_line(type = kind, id = obj.id, name = obj.name,
+                    created_at = obj.created_at, parent_id = obj.parent_id,
+                    fork_point = obj.fork_point)
+        elif kind == "step":
+            # Step data is written out as it is stored, without decoding it.
+            data = obj.data
+            encoded = data.raw if isinstance(data, LazyJSON) else json.dumps(data)
+            line = record_line(type = kind, id = obj.id, created_at = obj.created_at,
+                    tool = obj.tool, mimetype = obj.mimetype, prev_step_id = obj.prev_step_id)
+            yield '%s, "data": %s}\n' % (line[:-2], encoded)
+        else:
+            history_id, position, step_id = obj
+            yield record_line(type = kind, history_id = history_id, position = position, step_id = step_id)
+
+def record_line(**fields):
+    return json.dumps(fields, default = encode_value, sort_keys = True) + "\n"
+
+def encode_value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+def read_lines(lines):
+    """Parse exported lines back into records."""
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict) or record.get("type") not in RECORD_TYPES:
+            raise ValueError("Line %d is not a history, step or link" % (i + 1))
+        yield record
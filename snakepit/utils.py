@@ -1,6 +1,196 @@
+import json
+import re
+from collections import Mapping, Sequence
+from json.decoder import scanstring
+from datetime import datetime, timedelta, tzinfo
+
 def select_keys(d, keys, mapping = None):
     if mapping is None: mapping = {}
     return dict((mapping.get(k, k), v) for k, v in d.iteritems() if v is not None and k in keys)
 
 def unpack(d, keys):
     map(lambda k: d.get(k), keys)
+
+def chunked(iterable, size):
+    """Split an iterable into lists of (at most) the given size."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def setting(config, key, default, convert = int):
+    """Read an optional configuration value, which may be a string from the environment."""
+    value = config.get(key)
+    return default if value is None else convert(value)
+
+def truthy(value):
+    if isinstance(value, basestring):
+        return value.lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+class FixedOffset(tzinfo):
+    """A timezone a fixed number of minutes east of UTC."""
+
+    def __init__(self, minutes):
+        self._offset = timedelta(minutes = minutes)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+TIMESTAMP = re.compile(r"^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(?:(Z)|([+-])(\d\d):?(\d\d))?$")
+
+def parse_timestamp(value):
+    """Parse a timestamp in the format produced by datetime.isoformat."""
+    m = TIMESTAMP.match(value)
+    if m is None:
+        raise ValueError("Not a timestamp: %r" % (value))
+    fields = [int(f) for f in m.groups()[:6]]
+    micros = int((m.group(7) or "0").ljust(6, "0"))
+    tz = None
+    if m.group(8):
+        tz = FixedOffset(0)
+    elif m.group(9):
+        minutes = int(m.group(10)) * 60 + int(m.group(11))
+        tz = FixedOffset(minutes if m.group(9) == "+" else -minutes)
+    return datetime(*(fields + [micros, tz]))
+
+def parse_pointer(pointer):
+    """Split a JSON pointer (RFC 6901), eg. "/a/b~1c", into its keys."""
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise ValueError("Not a JSON pointer: %r" % (pointer))
+    return [k.replace("~1", "/").replace("~0", "~") for k in pointer[1:].split("/")]
+
+def is_array(value):
+    return isinstance(value, Sequence) and not isinstance(value, basestring)
+
+def json_contains(doc, pattern):
+    """
+    Whether a JSON value contains another, in the sense of Postgresql's
+    JSONB @> operator: objects contain objects with a subset of their
+    members, and arrays contain arrays with a subset of their elements.
+    """
+    if isinstance(pattern, Mapping):
+        return isinstance(doc, Mapping) and \
+                all(k in doc and json_contains(doc[k], v) for k, v in pattern.iteritems())
+    if is_array(pattern):
+        return is_array(doc) and \
+                all(any(json_contains(d, p) for d in doc) for p in pattern)
+    return isinstance(doc, bool) == isinstance(pattern, bool) and doc == pattern
+
+def json_equal(a, b):
+    """
+    Whether two JSON values are equal, in the sense of Postgresql's JSONB =
+    operator: unlike in Python, true is not 1.
+    """
+    if isinstance(a, Mapping):
+        return isinstance(b, Mapping) and len(a) == len(b) and \
+                all(k in b and json_equal(v, b[k]) for k, v in a.iteritems())
+    if is_array(a):
+        return is_array(b) and len(a) == len(b) and \
+                all(json_equal(x, y) for x, y in zip(a, b))
+    return not isinstance(b, Mapping) and not is_array(b) and \
+            isinstance(a, bool) == isinstance(b, bool) and a == b
+
+def json_path(doc, keys, default = None):
+    """The value at a path of keys (or array indices) in a JSON value."""
+    for key in keys:
+        if isinstance(doc, Mapping) and key in doc:
+            doc = doc[key]
+        elif is_array(doc) and key.isdigit() and int(key) < len(doc):
+            doc = doc[int(key)]
+        else:
+            return default
+    return doc
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRUCTURE = re.compile(r'[\[\]{}"]')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_decoder = json.JSONDecoder()
+
+def select_paths(text, paths, default = None):
+    """
+    Pick the values at some paths of keys out of a JSON encoded document,
+    decoding only those values, and only skimming over the rest of the text.
+    Returns the values in the order of the paths, with default for those
+    that are not there.
+    """
+    wanted = {}
+    for i, path in enumerate(paths):
+        node = wanted
+        for key in path:
+            node = node.setdefault(key, {})
+        node.setdefault(None, []).append(i)
+    found = [default] * len(paths)
+    _select(text, _skip_space(text, 0), wanted, found)
+    return found
+
+def _skip_space(text, idx):
+    return _WHITESPACE.match(text, idx).end()
+
+def _select(text, idx, wanted, found):
+    """Select the wanted values from the value at idx, returning its end."""
+    if None in wanted:
+        value, end = _decoder.raw_decode(text, idx)
+        _fill(value, wanted, found)
+        return end
+    opener = text[idx:idx + 1]
+    if opener not in ('{', '['):
+        return _skip(text, idx)
+    idx = _skip_space(text, idx + 1)
+    closer, position = ('}', None) if opener == '{' else (']', 0)
+    while text[idx] != closer:
+        if position is None:
+            key, idx = scanstring(text, idx + 1)
+            idx = _skip_space(text, _skip_space(text, idx) + 1)
+        else:
+            key, position = str(position), position + 1
+        if key in wanted:
+            idx = _select(text, idx, wanted[key], found)
+        else:
+            idx = _skip(text, idx)
+        idx = _skip_space(text, idx)
+        if text[idx] == ',':
+            idx = _skip_space(text, idx + 1)
+    return idx + 1
+
+def _fill(value, wanted, found):
+    """Select the wanted values from one that has already been decoded."""
+    for key, node in wanted.iteritems():
+        if key is None:
+            for i in node:
+                found[i] = value
+        else:
+            child = json_path(value, [key], _fill)
+            if child is not _fill:
+                _fill(child, node, found)
+
+def _skip(text, idx):
+    """Find the end of the value at idx without decoding it."""
+    opener = text[idx]
+    if opener == '"':
+        return _STRING.match(text, idx).end()
+    if opener not in ('{', '['):
+        return _decoder.raw_decode(text, idx)[1]
+    depth = 0
+    while True:
+        m = _STRUCTURE.search(text, idx)
+        char = m.group()
+        if char == '"':
+            idx = _STRING.match(text, m.start()).end()
+            continue
+        depth += 1 if char in ('{', '[') else -1
+        idx = m.end()
+        if depth == 0:
+            return idx
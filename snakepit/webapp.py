@@ -1,24 +1,54 @@
 from flask import Flask, g, flash, request, session, redirect, \
         make_response, url_for, abort, render_template, flash, json
 
+from collections import Mapping
 from datetime import datetime, timedelta
+from uuid import UUID
+import hashlib
+import threading
+import time
 import os.path as path
 from flask_negotiate import consumes, produces
 from flask_oauthlib.provider import OAuth2Provider
+from werkzeug.http import quote_etag, unquote_etag
 import logging
 
 # snakepit code
-from security import test_pw, Authenticator
-from utils import select_keys
+from security import hash_pw, test_pw, needs_rehash, configure_hashing, Authenticator
+from cache import LRUCache
+from sqltypes import LazyJSON
+from compression import compress, configure_compression
+from utils import select_keys, setting, truthy, parse_timestamp, parse_pointer
 import config
 import data
+import maintenance
+import delta
+import transfer
+import batching
+import subscriptions
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
 
 templates = path.realpath(path.join(path.dirname(__file__), "..", "templates"))
 
+class JSONEncoder(json.JSONEncoder):
+    """Serialises the read-only values that step data is loaded as."""
+
+    def default(self, o):
+        if isinstance(o, LazyJSON):
+            return o.value
+        if isinstance(o, Mapping):
+            return dict(o)
+        return super(JSONEncoder, self).default(o)
+
 app = Flask('snakepit', template_folder = templates)
 app.config.update(config.Config())
+app.json_encoder = JSONEncoder
 
 oauth = OAuth2Provider(app)
+configure_hashing(app.config)
+configure_compression(app.config)
 
 if not app.debug:
     from logging.handlers import RotatingFileHandler
@@ -36,15 +66,50 @@ def init_db():
     """Creates the database tables."""
     with app.app_context():
         get_datastore().create_db()
+        for shard, store in data.history_stores(app.config):
+            if shard is not None:
+                store.create_db()
 
-def get_datastore():
+def get_datastore(read_only = False):
     """Opens a new database connection if there is none yet for the
     current application context.
+
+    Read only connections go to a replica, if there are any, unless the
+    client wrote something too recently for the replicas to have it.
     """
+    if read_only:
+        if not hasattr(g, 'replica_datastore'):
+            g.replica_datastore = data.Store(app.config, read_only = True, sticky = recently_wrote())
+        return g.replica_datastore
     if not hasattr(g, 'datastore'):
         g.datastore = data.Store(app.config)
     return g.datastore
 
+def get_history_store(read_only = False):
+    """
+    The datastore that holds the current user's histories and steps. This
+    is the main one, unless histories are sharded across databases by user,
+    in which case it is their shard.
+    """
+    if not data.shard_urls(app.config):
+        return get_datastore(read_only)
+    name = 'shard_reader' if read_only else 'shard_datastore'
+    if not hasattr(g, name):
+        setattr(g, name, data.Store(app.config, read_only = read_only, user_id = session["user"]["id"]))
+    return getattr(g, name)
+
+DATASTORES = ['datastore', 'replica_datastore', 'shard_datastore', 'shard_reader']
+
+def recently_wrote():
+    window = setting(app.config, "READ_YOUR_WRITES_WINDOW", 5, float)
+    return time.time() - session.get('last_write', 0) < window
+
+@app.after_request
+def remember_writes(response):
+    if any(getattr(g, name).committed for name in DATASTORES if hasattr(g, name)):
+        session['last_write'] = time.time()
+    return response
+
 def wants_json():
     best = request.accept_mimetypes.best_match(["application/json", "text/html"])
     return best == "application/json" and \
@@ -55,11 +120,42 @@ def failed_auth():
         return redirect(url_for('login'))
     return abort(403)
 
-auth = Authenticator(get_datastore, failed_auth)
+auth = Authenticator(get_datastore, failed_auth, LRUCache(
+    max_size = setting(app.config, "ROLE_CACHE_SIZE", 10000),
+    ttl = setting(app.config, "ROLE_CACHE_TTL", 300)))
+data.listen("user_changed", auth.forget_user)
+
+# Clients and tokens are looked up on every OAuth request, and are cached
+# for at most CLIENT_CACHE_TTL and TOKEN_CACHE_TTL seconds (and never past
+# a token's expiry), which bounds how long a change made by another
+# process can go unnoticed. Tokens replaced in this process are forgotten
+# straight away.
+clients = LRUCache(
+    max_size = setting(app.config, "CLIENT_CACHE_SIZE", 1000),
+    ttl = setting(app.config, "CLIENT_CACHE_TTL", 300))
+tokens = LRUCache(max_size = setting(app.config, "TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = setting(app.config, "TOKEN_CACHE_TTL", 60)
+
+def token_key(kind, value):
+    return (kind, hashlib.sha256(value.encode("utf-8")).hexdigest())
+
+def forget_token(access_token, refresh_token):
+    for kind, value in [("access_token", access_token), ("refresh_token", refresh_token)]:
+        if value:
+            tokens.discard(token_key(kind, value))
+
+data.listen("token_revoked", forget_token)
 
 @oauth.clientgetter
 def load_client(client_id):
-    return get_datastore().fetch_client({"id": client_id})
+    client = clients.get(client_id)
+    if client is None:
+        with get_datastore() as store:
+            client = store.fetch_client({"id": client_id})
+            store.detach(client)
+        if client is not None:
+            clients.put(client_id, client)
+    return client
 
 @oauth.grantgetter
 def load_grant(client_id, code):
@@ -75,30 +171,53 @@ def save_grant(client_id, code, req, *args, **kwargs):
     with get_datastore() as store:
         client = store.fetch_client({"id": client_id})
         user = store.fetch_user(**session["user"])
-        grant = store.add_grant(user, client, code, redirect_uri, scopes, expires)
+        grant = store.save_grant(user, client, code, redirect_uri, scopes, expires)
     return grant
 
 @oauth.tokengetter
 def load_token(**kwargs):
-    keys = ["access_token", "refresh_token"]
-    with get_datastore() as store:
-        return store.get_token(select_keys(kwargs, keys))
+    constraint = select_keys(kwargs, ["access_token", "refresh_token"])
+    if not constraint:
+        return None
+    key = token_key(*constraint.items()[0])
+    tok = tokens.get(key)
+    if tok is None:
+        with get_datastore() as store:
+            tok = store.get_token(constraint)
+            if tok is not None:
+                store.detach(tok, tok.user, tok.client)
+        if tok is not None:
+            ttl = min(TOKEN_CACHE_TTL, (tok.expires - datetime.utcnow()).total_seconds())
+            if ttl > 0:
+                tokens.put(key, tok, ttl)
+    return tok
 
 @oauth.tokensetter
 def save_token(token, req, *args, **kwargs):
     with get_datastore() as store:
         client = store.fetch_client({"id": req.client.client_id})
-        user = store.fetch_user({"id": req.user.id})
+        user = store.fetch_user(id = req.user.id)
         return store.add_token(client, user, token)
 
 @oauth.usergetter
 def get_user(username, password, *args, **kwargs):
     with get_datastore() as store:
-        user = store.fetch_user({"name": username})
-        if user and test_pw(password, user.passhash):
+        user = store.fetch_user(name = username)
+        if user and check_password(user, password):
             return user
     return None
 
+def check_password(user, password):
+    """
+    Check a user's password, upgrading their hash if it was made with a
+    different cost to the one currently configured.
+    """
+    if not test_pw(password, user.passhash):
+        return False
+    if needs_rehash(user.passhash):
+        user.passhash = hash_pw(password)
+    return True
+
 @app.route('/oauth2/authorize', methods = ['GET', 'POST'])
 @auth.requires_roles('user')
 @oauth.authorize_handler
@@ -117,11 +236,62 @@ def authorize(*args, **kwargs):
 def access_token():
     return {'version': '0.1.0'}
 
+background_jobs = []
+
+def run_sweeper():
+    store = data.Store(app.config)
+    batch_size = setting(app.config, "SWEEP_BATCH_SIZE", 1000)
+    try:
+        report = maintenance.sweep_expired(store, batch_size)
+    finally:
+        store.close()
+    if setting(app.config, "STEP_DEDUPLICATION", False, truthy):
+        report.update(on_history_stores(lambda store: maintenance.sweep_payloads(store, batch_size,
+            setting(app.config, "PAYLOAD_GRACE_PERIOD", 3600))))
+    return report
+
+def run_collector():
+    return on_history_stores(lambda store: maintenance.collect_garbage(store,
+        setting(app.config, "GC_BATCH_SIZE", 1000),
+        setting(app.config, "GC_MAX_BATCHES", 100),
+        setting(app.config, "GC_PAUSE", 0.1, float)))
+
+def on_history_stores(job):
+    """Run a job on each database that holds histories, reporting by shard if they are sharded."""
+    reports = {}
+    for shard, store in data.history_stores(app.config):
+        try:
+            report = job(store)
+        finally:
+            store.close()
+        if shard is None:
+            return report
+        reports[shard] = report
+    return reports
+
+@app.before_first_request
+def start_background_jobs():
+    """
+    Start the optional maintenance jobs, and feeding changes to histories
+    to their subscribers. This happens on the first request, rather than at
+    import, so that each worker process starts its own.
+    """
+    sweep_interval = setting(app.config, "SWEEP_INTERVAL", None)
+    if sweep_interval:
+        background_jobs.append(maintenance.PeriodicJob("sweeper", sweep_interval, run_sweeper))
+    gc_interval = setting(app.config, "GC_INTERVAL", None)
+    if gc_interval:
+        background_jobs.append(maintenance.PeriodicJob("collector", gc_interval, run_collector))
+    for job in background_jobs:
+        job.start()
+    subscriptions.feed(hub, app.config)
+
 @app.teardown_appcontext
 def close_db(error):
     """Closes the database again at the end of the request."""
-    if hasattr(g, 'datastore'):
-        g.datastore.close()
+    for name in DATASTORES:
+        if hasattr(g, name):
+            getattr(g, name).close()
 
 @app.route("/")
 def hello():
@@ -131,14 +301,14 @@ def hello():
 def login():
     error = None
     if request.method == 'POST':
-        store = get_datastore()
-        user = store.fetch_user(name = request.form['username'])
-        if user is None:
-            error = 'Invalid username'
-        elif not test_pw(request.form['password'], user.passhash):
-            error = 'Invalid password'
-        else:
-            return login_user(user)
+        with get_datastore() as store:
+            user = store.fetch_user(name = request.form['username'])
+            if user is None:
+                error = 'Invalid username'
+            elif not check_password(user, request.form['password']):
+                error = 'Invalid password'
+            else:
+                return login_user(user)
     return render_template('login.html', error=error)
 
 def login_user(user):
@@ -152,12 +322,66 @@ def logout():
     flash('You were logged out')
     return redirect(url_for('login'))
 
+# A position in a history always refers to the same step, and steps are
+# never changed once they are created.
+IMMUTABLE = "private, max-age=31536000, immutable"
+REVALIDATE = "private, no-cache"
+
+def cache_headers(tag, weak = False, cache_control = REVALIDATE, vary = "Accept"):
+    """
+    Validator headers for a resource, with one ETag per representation.
+    """
+    etag = quote_etag("%s-%s" % (tag, "json" if wants_json() else "html"), weak)
+    return [('ETag', etag), ('Cache-Control', cache_control), ('Vary', vary)]
+
+def is_fresh(headers):
+    """
+    Whether the client already has the representation with these headers.
+    """
+    etag, weak = unquote_etag(dict(headers)['ETag'])
+    return request.if_none_match.contains_weak(etag)
+
+def not_modified(headers):
+    return '', 304, headers
+
+# Since steps never change, their (shard, history, position) addresses and
+# their serialised forms can be cached for as long as there is room for
+# them, or until histories or steps are deleted.
+step_ids = LRUCache(max_size = setting(app.config, "STEP_ID_CACHE_SIZE", 100000))
+data.listen("histories_deleted", lambda user_id: step_ids.clear())
+data.listen("steps_deleted", lambda count: step_ids.clear())
+step_responses = LRUCache(
+    max_size = setting(app.config, "STEP_CACHE_SIZE", 10000),
+    max_weight = setting(app.config, "STEP_CACHE_BYTES", 64 * 1024 * 1024))
+
+def step_envelope(step):
+    """The JSON text either side of a step's data."""
+    fields = json.dumps({"tool_url": step.tool, "mimetype": step.mimetype})
+    return fields[:-1] + ', "data": ', '}'
+
+def step_json(step):
+    """
+    A step as JSON. Its data is sent as it was stored, without being
+    decoded and encoded again.
+    """
+    data = step.data
+    encoded = data.raw if isinstance(data, LazyJSON) else json.dumps(data)
+    before, after = step_envelope(step)
+    return app.response_class(before + encoded + after, mimetype = JSON)
+
+# Content codings, in order of preference.
+ENCODINGS = ["gzip", "deflate"]
+
+def response_codec():
+    """The compression to send the response with, if any."""
+    # Not best_match, which picks codings that were refused with q=0.
+    qualities = [(request.accept_encodings[e], -i, e) for i, e in enumerate(ENCODINGS)]
+    quality, _, best = max(qualities)
+    return best if quality > 0 else None
+
 def return_step(step, code = 200, headers = None):
     if wants_json():
-        payload = json.jsonify(
-                tool_url = step.tool,
-                mimetype = step.mimetype,
-                data = step.data)
+        payload = step_json(step)
     else:
         payload = render_template("show_step", step = step)
 
@@ -166,89 +390,423 @@ def return_step(step, code = 200, headers = None):
 @app.route("/histories/<uuid>/<int:idx>")
 @auth.requires_roles("user")
 def show_step(uuid, idx):
-    store = get_datastore()
-    h = store.fetch_history(id = uuid)
-    if h is None or len(h.steps) <= idx:
+    store = get_history_store(read_only = True)
+    address = (store.shard, uuid, idx)
+    step, step_id = None, step_ids.get(address)
+    if step_id is None:
+        step = store.fetch_step(uuid, idx)
+        if step is None:
+            return abort(404)
+        step_id = step.id
+        step_ids.put(address, step_id)
+
+    def load():
+        # A cached address can outlive its step, if this process has not heard that it went.
+        found = step or store.get_step(step_id)
+        if found is None:
+            step_ids.discard(address)
+            abort(404)
+        return found
+    fields, tag = requested_fields(), step_id
+    if fields:
+        tag = "%s-%s" % (step_id, hashlib.md5(",".join(fields).encode('utf-8')).hexdigest())
+    codec = response_codec() if wants_json() else None
+    if codec is not None:
+        tag = "%s-%s" % (tag, codec)
+    headers = cache_headers(tag, cache_control = IMMUTABLE, vary = "Accept, Accept-Encoding")
+    if is_fresh(headers):
+        return not_modified(headers)
+    if not wants_json():
+        return return_step(load(), 200, headers)
+
+    key = (str(step_id), JSON, codec) + tuple(fields)
+    body = step_responses.get(key)
+    if body is None:
+        if fields:
+            found = step_fields_json(store, step_id, fields)
+            if found is None:
+                step_ids.discard(address)
+                return abort(404)
+            body = found.data
+            if codec is not None:
+                body = compress(body, codec)
+        elif codec is not None:
+            # One stream, as many clients only read the first of several gzip members.
+            body = compress(step_json(load()).data, codec)
+        else:
+            body = step_json(load()).data
+        step_responses.put(key, body)
+    if codec is not None:
+        headers.append(('Content-Encoding', codec))
+    return app.response_class(body, mimetype = JSON), 200, headers
+
+def requested_fields():
+    """
+    The parts of the step data asked for with ?fields=, as JSON pointers
+    (eg. /where/id) or top level keys, separated by commas.
+    """
+    return [f for arg in request.args.getlist('fields') for f in arg.split(',') if f]
+
+def step_fields_json(store, step_id, fields):
+    try:
+        paths = [parse_pointer(f) if f.startswith('/') else [f] for f in fields]
+    except ValueError as e:
+        raise InputError(str(e))
+    selected = store.select_step_data(step_id, paths)
+    if selected is None:
+        return None
+    step, values = selected
+    return json.jsonify(
+            tool_url = step.tool,
+            mimetype = step.mimetype,
+            data = dict((f, v) for f, v in zip(fields, values) if v is not data.ANY))
+
+MAX_LINEAGE_DEPTH = 1000
+
+def show_lineage(uuid, idx, walk):
+    store = get_history_store(read_only = True)
+    step = store.fetch_step(uuid, idx)
+    if step is None:
         return abort(404)
-    step = h.steps[idx]
-    return return_step(step)
+    depth = min(request.args.get('depth', MAX_LINEAGE_DEPTH, type = int), MAX_LINEAGE_DEPTH)
+    seen, steps = set(), []
+    for s, d, history_id, position in walk(step.id, depth):
+        if s.id in seen:
+            continue
+        seen.add(s.id)
+        url = None if history_id is None else url_for('show_step', uuid = history_id, idx = position)
+        steps.append({"url": url, "id": s.id, "previous": s.prev_step_id, "depth": d,
+            "tool": s.tool, "mimetype": s.mimetype, "created_at": s.created_at})
+    return json.jsonify(steps = steps)
+
+@app.route('/histories/<uuid>/<int:idx>/ancestry')
+@auth.requires_roles('user')
+@produces('application/json')
+def show_ancestry(uuid, idx):
+    return show_lineage(uuid, idx, get_history_store(read_only = True).step_ancestry)
+
+@app.route('/histories/<uuid>/<int:idx>/descendants')
+@auth.requires_roles('user')
+@produces('application/json')
+def show_descendants(uuid, idx):
+    return show_lineage(uuid, idx, get_history_store(read_only = True).step_descendants)
 
 @app.route('/histories/<uuid>/<int:idx>/next', methods = ['POST'])
 @auth.requires_roles('user')
 def add_next_step(uuid, idx):
-    with get_datastore() as store:
-        h      = store.fetch_history(id = uuid)
-        step_data = request.json
-        next_i = idx + 1
+    step_data = request.json
+    next_i = idx + 1
+
+    def append(store):
+        h = store.fetch_history(id = uuid)
 
         if h is None: return abort(404)
         if step_data is None: raise InputError("Missing required data")
         args = select_keys(step_data, ['tool', 'mimetype', 'data'])
 
-        if len(h.steps) == next_i:
-            step = h.append_step(**args)
-            url = url_for('show_step', uuid = h.id, idx = next_i)
-        else:
-            forked = store.fork_history({'id': h.id}, next_i)
-            step = forked.append_step(**args)
-            url = url_for('show_step', uuid = forked.id, idx = next_i)
+        length = store.history_length(h.id)
+        if length < next_i: return abort(404)
 
+        if length == next_i:
+            return h.append_step(**args), h.id
+        forked = store.fork_history({'id': h.id}, next_i)
+        return forked.append_step(**args), forked.id
+
+    step, history_id = write_steps(append)
+    url = url_for('show_step', uuid = history_id, idx = next_i)
     return return_step(step, 201, [('Location', url)])
 
 @app.errorhandler(InputError)
 def handle_input_error(err):
-    return make_response(standard_response(None, 400, err.message), 400)
+    return make_response(json.jsonify(error = err.message), 400)
+
+@app.errorhandler(data.HistoryConflict)
+def handle_conflict(err):
+    return make_response(json.jsonify(error = "The history is being changed too often, please try again"), 409)
+
+@app.errorhandler(data.AlreadyImported)
+def handle_already_imported(err):
+    return make_response(json.jsonify(error = "Some of these histories have been imported already"), 409)
+
+@app.errorhandler(data.UserMoving)
+def handle_user_moving(err):
+    retry = setting(app.config, "SHARD_PLACEMENT_TTL", 5, float)
+    return make_response(json.jsonify(error = "Your histories are being moved, please try again shortly"),
+            503, [('Retry-After', str(int(retry) + 1))])
 
 @app.route('/histories/<uuid>', methods = ['POST'])
 @auth.requires_roles('user')
 @produces('application/json', 'text/html')
 def add_step(uuid):
-    with get_datastore() as store:
-        store     = get_datastore()
-        h         = store.fetch_history(id = uuid)
-        step_data = request.json
+    step_data = request.json
+
+    def append(store):
+        h = store.fetch_history(id = uuid)
 
         if h is None: return abort(404)
         if step_data is None: raise InputError("Missing required data")
 
-        step = h.append_step(step_data['tool'], step_data['mimetype'],
-                step_data['data'])
-        url = url_for('show_step', uuid = uuid, idx = len(h.steps) - 1)
+        idx = store.history_length(h.id)
+        return h.append_step(step_data['tool'], step_data['mimetype'], step_data['data']), idx
+
+    step, idx = write_steps(append)
+    url = url_for('show_step', uuid = uuid, idx = idx)
     return return_step(step, 201, [('Location', url)])
 
+committers = {}
+committers_lock = threading.Lock()
+
+def write_steps(append):
+    """
+    Run append(store) and commit it. With GROUP_COMMIT on, it is committed
+    along with other requests' appends (see batching.GroupCommitter).
+
+    If another request appends to the same history first, append is run
+    again (see data.retrying), so that it can see the new length.
+    """
+    return retry_conflicts(lambda: commit_steps(append))
+
+def retry_conflicts(work):
+    return data.retrying(work,
+            setting(app.config, "APPEND_ATTEMPTS", 5),
+            setting(app.config, "APPEND_BACKOFF", 0.01, float))
+
+def commit_steps(append):
+    if not setting(app.config, "GROUP_COMMIT", False, truthy):
+        with get_history_store() as store:
+            return append(store)
+    shard = data.shard_of(app.config, session["user"]["id"])
+    with committers_lock:
+        if shard not in committers:
+            committers[shard] = batching.GroupCommitter(lambda: data.Store(app.config, shard = shard),
+                    setting(app.config, "GROUP_COMMIT_BATCH_SIZE", 64),
+                    setting(app.config, "GROUP_COMMIT_LATENCY", 0.005, float))
+        committer = committers[shard]
+    result = committer.submit(append)
+    session['last_write'] = time.time()
+    return result
+
+def page_size(default = 50, maximum = 1000):
+    limit = request.args.get('limit', default, type = int)
+    return max(1, min(limit, maximum))
+
+STEP_FIELDS = ['tool', 'mimetype', 'data']
+
+def step_records():
+    """
+    The steps in the request body, which is either a JSON array or a
+    stream of newline delimited JSON objects.
+    """
+    if request.mimetype == NDJSON:
+        records = (parse_json_line(line) for line in request.stream if line.strip())
+    else:
+        records = request.json
+        if not isinstance(records, list):
+            raise InputError("Expected an array of steps")
+    for i, record in enumerate(records):
+        if not isinstance(record, dict) or any(k not in record for k in STEP_FIELDS):
+            raise InputError("Step %d must have a tool, mimetype and data" % (i))
+        yield dict((k, record[k]) for k in STEP_FIELDS)
+
+def parse_json_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise InputError("Invalid JSON: %s" % (line[:100]))
+
+@app.route('/histories/<uuid>/steps', methods = ['POST'])
+@auth.requires_roles('user')
+@produces('application/json')
+def add_steps(uuid):
+    def append():
+        with get_history_store() as store:
+            h = store.fetch_history(id = uuid)
+            if h is None: return abort(404)
+            return store.append_steps(h, step_records())
+    # A streamed body cannot be read again, so its client retries instead.
+    start, step_ids = append() if request.mimetype == NDJSON else retry_conflicts(append)
+    urls = [url_for('show_step', uuid = uuid, idx = start + i) for i in range(len(step_ids))]
+    return json.jsonify(steps = urls), 201
+
 @app.route('/histories/<uuid>', methods = ['GET'])
 @auth.requires_roles('user')
 @produces('application/json', 'text/html')
 def show_history(uuid):
-    store = get_datastore()
-    h = store.fetch_history(id = uuid)
-    if h is None:
+    store = get_history_store(read_only = True)
+    length = store.history_length(uuid)
+    if length is None:
         return abort(404)
-    indexed_steps = zip(h.steps, range(len(h.steps)))
+    headers = cache_headers("%s-%d" % (uuid, length), weak = True)
+    if is_fresh(headers):
+        return not_modified(headers)
+    after = request.args.get('after', -1, type = int)
+    limit = page_size()
+    h = store.fetch_history(id = uuid)
+    page = h.steps_between(after + 1, min(length, after + 1 + limit))
     steps = [ {"url": url_for("show_step", uuid = h.id, idx = i), "created_at": s.created_at} \
-            for s, i in indexed_steps]
+            for i, s in page]
+    next_page = None
+    if page and page[-1][0] + 1 < length:
+        next_page = url_for('show_history', uuid = h.id, after = page[-1][0], limit = limit)
     if wants_json():
-        return json.jsonify(name = h.name, created_at = h.created_at, steps = steps)
+        return json.jsonify(name = h.name, created_at = h.created_at, length = length,
+                steps = steps, next = next_page), 200, headers
     else:
-        return render_template('show_history.html', history = history, steps = indexed_steps)
+        indexed_steps = [(s, i) for i, s in page]
+        return render_template('show_history.html', history = h, steps = indexed_steps), 200, headers
+
+EVENT_STREAM = "text/event-stream"
+
+hub = subscriptions.Hub()
+
+@app.route('/histories/<uuid>/events', methods = ['GET'])
+@auth.requires_roles('user')
+@produces(EVENT_STREAM, 'application/json')
+def watch_history(uuid):
+    """
+    The changes to a history after the step at position ?after (or the
+    Last-Event-ID, by default its last step): new steps, and forks. Either
+    as a stream of server-sent events, or for long polling, as JSON once
+    there are any, or after ?timeout seconds.
+
+    Only steps have event ids, as the Last-Event-ID is a position, so the
+    forks made while a client was disconnected are not sent again when it
+    reconnects: it should list the histories to find them.
+    """
+    try:
+        UUID(uuid)
+    except ValueError:
+        return abort(404)
+    # Subscribe first, so that nothing committed after the length is read is missed.
+    subscription, streaming = hub.subscribe(uuid), False
+    try:
+        length = get_history_store().history_length(uuid)
+        if length is None:
+            return abort(404)
+        after = request.headers.get('Last-Event-ID', request.args.get('after', length - 1, type = int), type = int)
+        urls = url_for('show_histories'), url_for('show_history', uuid = uuid)
+        if request.accept_mimetypes.best_match([EVENT_STREAM, JSON]) == EVENT_STREAM:
+            keepalive = setting(app.config, "EVENTS_KEEPALIVE", 15, float)
+            changes = history_changes(urls, after, length, lambda: subscription.get(keepalive))
+            streaming = True
+            return app.response_class(event_stream(changes, subscription), mimetype = EVENT_STREAM,
+                    headers = [('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')])
+        timeout = max(0, min(request.args.get('timeout', 30, type = float), setting(app.config, "EVENTS_MAX_WAIT", 60, float)))
+        found = []
+        for change in history_changes(urls, after, length, lambda: subscription.get(0 if found else timeout)):
+            if change is None:
+                break
+            found.append(change)
+        return json.jsonify(events = [dict(body, event = event) for event, _, body in found])
+    finally:
+        if not streaming:
+            subscription.close()
+
+def history_changes(urls, after, length, wait):
+    """
+    Generate the changes to a history after position after, as (event, id,
+    data) triples: first the steps it already has, then each change that
+    wait() returns. None stands for wait() returning nothing.
+    """
+    histories_url, history_url = urls
+    seen, change = after, ("steps", after + 1, length)
+    while True:
+        if change is None:
+            yield None
+        elif change[0] == "steps":
+            for i in range(max(change[1], seen + 1), change[2]):
+                seen = i
+                yield "step", i, {"url": "%s/%d" % (history_url, i), "position": i}
+        else:
+            yield "fork", None, {"url": "%s/%s" % (histories_url, change[1]), "fork_point": change[2]}
+        change = wait()
+
+def event_stream(changes, subscription):
+    """Changes as server-sent events, with a comment to keep the connection alive when there are none."""
+    try:
+        yield "retry: 2000\n\n"
+        for change in changes:
+            if change is None:
+                yield ": keepalive\n\n"
+                continue
+            event, event_id, body = change
+            lines = "event: %s\ndata: %s\n\n" % (event, json.dumps(body))
+            yield lines if event_id is None else "id: %d\n%s" % (event_id, lines)
+    finally:
+        subscription.close()
+
+def history_cursor(after):
+    try:
+        created_at, history_id = after.rsplit(',', 1)
+        return parse_timestamp(created_at), str(UUID(history_id))
+    except ValueError:
+        raise InputError("after must be of the form <created_at>,<id>")
 
 @app.route('/histories', methods=['GET'])
 @auth.requires_roles('user')
 @produces('application/json', 'text/html')
 def show_histories():
-    user = get_datastore().fetch_user(**session["user"])
-    hs = [ {"url": url_for('show_history', uuid = h.id), "created_at": h.created_at} \
-            for h in user.histories]
+    after = request.args.get('after')
+    if after is not None:
+        after = history_cursor(after)
+    limit = page_size()
+    page = get_history_store(read_only = True).list_histories(session["user"]["id"], after, limit)
+    versions = [(h.id, length, updated_at) for h, length, updated_at in page]
+    headers = cache_headers(hashlib.md5(repr(versions)).hexdigest(), weak = True)
+    if is_fresh(headers):
+        return not_modified(headers)
+    hs = [ {"url": url_for('show_history', uuid = h.id), "created_at": h.created_at,
+            "step_count": length, "updated_at": updated_at} \
+            for h, length, updated_at in page]
+    next_page = None
+    if len(page) == limit:
+        last = page[-1][0]
+        next_page = url_for('show_histories', limit = limit,
+                after = "%s,%s" % (last.created_at.isoformat(), last.id))
     if wants_json():
-        return json.jsonify(histories = hs)
+        return json.jsonify(histories = hs, next = next_page), 200, headers
     else:
-        return render_template('show_histories.html', histories = user.histories)
+        histories = [h for h, _, _ in page]
+        return render_template('show_histories.html', histories = histories), 200, headers
+
+def json_arg(name, default = None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise InputError("%s must be JSON" % (name))
+
+@app.route('/steps', methods=['GET'])
+@auth.requires_roles('user')
+@produces('application/json')
+def search_steps():
+    """
+    Search the user's steps by their data, eg. ?contains={"a":1} or
+    ?path=/a/b&value=1, or just ?path=/a/b for steps with anything there.
+    """
+    contains = json_arg('contains')
+    value = json_arg('value', data.ANY)
+    path = request.args.get('path')
+    if path is not None:
+        try:
+            path = parse_pointer(path)
+        except ValueError as e:
+            raise InputError(str(e))
+    if contains is None and not path:
+        raise InputError("contains or path is required")
+    found = get_history_store(read_only = True).search_steps(session["user"]["id"], contains, path, value, page_size())
+    steps = [ {"url": url_for('show_step', uuid = history_id, idx = position),
+               "tool": s.tool, "mimetype": s.mimetype, "created_at": s.created_at} \
+            for s, history_id, position in found]
+    return json.jsonify(steps = steps)
 
 @app.route('/histories', methods=['POST'])
 @auth.requires_roles('user')
 @produces('application/json', 'text/html')
 def create_history():
-    with get_datastore() as store:
+    with get_history_store() as store:
         user = store.fetch_user(**session["user"])
         name = request.form['histname']
         history = user.new_history(name)
@@ -258,6 +816,52 @@ def create_history():
     else:
         return redirect(url)
 
+@app.route('/export', methods=['GET'])
+@auth.requires_roles('user')
+@produces(NDJSON)
+def export_histories():
+    """Stream all the user's histories and their steps as NDJSON."""
+    user_id = session["user"]["id"]
+    sticky = recently_wrote()
+    def generate():
+        # The response outlives the request's datastore.
+        store = data.Store(app.config, read_only = True, sticky = sticky, user_id = user_id)
+        try:
+            for line in transfer.export_lines(store, user_id):
+                yield line
+        finally:
+            store.close()
+    return app.response_class(generate(), mimetype = NDJSON)
+
+@app.route('/import', methods=['POST'])
+@auth.requires_roles('user')
+@consumes(NDJSON)
+@produces('application/json')
+def import_histories():
+    """Add histories and steps from an export, keeping their ids."""
+    try:
+        with get_history_store() as store:
+            counts = store.import_histories(session["user"]["id"], transfer.read_lines(request.stream))
+    except (ValueError, KeyError) as e:
+        raise InputError("Invalid export: %s" % (e))
+    return json.jsonify(imported = counts), 201
+
+@app.route('/status', methods=['GET'])
+@auth.requires_roles('admin')
+@produces('application/json')
+def show_status():
+    return json.jsonify(
+            pools = data.pool_statistics(),
+            routing = data.routing_statistics(app.config),
+            role_cache = auth.role_cache.statistics(),
+            step_cache = step_responses.statistics(),
+            frame_cache = delta.frames.statistics(),
+            subscriptions = hub.statistics(),
+            group_commit = dict((str(shard), c.statistics()) for shard, c in committers.items()),
+            client_cache = clients.statistics(),
+            token_cache = tokens.statistics(),
+            jobs = dict((job.name, job.last_report) for job in background_jobs))
+
 @app.route('/register', methods=['GET'])
 @produces('text/html')
 def register(): return render_template('register.html')
@@ -1,10 +1,38 @@
 from nose.tools import *
+import json
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from nose.plugins.skip import SkipTest
+from uuid import uuid4
 
 import snakepit
+import snakepit.batching
+import snakepit.compression
+import snakepit.delta
+import snakepit.maintenance
+import snakepit.sharding
+import snakepit.subscriptions
+import snakepit.transfer
+from snakepit.schema import Client, Grant, BearerToken, Payload, Step, History, HistoryStep, UserShard
 
 CONFIG = snakepit.config.Config("TEST")
 USER = {"name": "test user", "email": "foo@bar.com", "password": "foo"}
 
+class TestPasswordHasher(object):
+
+    def test_can_check_passwords(self):
+        hasher = snakepit.security.PasswordHasher(rounds = 4, processes = 1)
+        hashed = hasher.hash("foo")
+        ok_(hasher.check("foo", hashed))
+        assert_false(hasher.check("bar", hashed))
+
+    def test_knows_when_to_rehash(self):
+        hashed = snakepit.security.PasswordHasher(rounds = 4, processes = 0).hash("foo")
+        assert_false(snakepit.security.PasswordHasher(rounds = 4).needs_rehash(hashed))
+        ok_(snakepit.security.PasswordHasher(rounds = 5).needs_rehash(hashed))
+
 class StoreFixture(object):
 
     @classmethod
@@ -29,6 +57,31 @@ class TestStore(StoreFixture):
     def test_1(self):
         data_store = snakepit.data.Store(CONFIG)
 
+    def test_only_transactions_that_write_count_as_committed(self):
+        with self.store:
+            self.store.session.query(Step).count()
+        ok_(not self.store.committed)
+        with self.store:
+            self.store.add_user(dict(name = "writer", email = "w@foo.com", password = "w"))
+        ok_(self.store.committed)
+
+    def test_stores_share_an_engine(self):
+        data_store = snakepit.data.Store(CONFIG)
+        ok_(data_store.__engine__ is self.store.__engine__)
+        ok_(snakepit.data.public_url(CONFIG['DB_URL']) in snakepit.data.pool_statistics())
+
+    def test_reads_are_routed_to_replicas(self):
+        config = dict(DB_URL = CONFIG['DB_URL'], DB_REPLICA_URLS = "sqlite://")
+        replica = snakepit.data.get_engine(config, "sqlite://")
+        before = snakepit.data.routing_statistics(config)["routes"]
+        ok_(snakepit.data.Store(config, read_only = True).__engine__ is replica)
+        ok_(snakepit.data.Store(config, read_only = True, sticky = True).__engine__ is self.store.__engine__)
+        ok_(snakepit.data.Store(config).__engine__ is self.store.__engine__)
+        stats = snakepit.data.routing_statistics(config)
+        for route in ("replica", "sticky", "primary"):
+            eq_(before.get(route, 0) + 1, stats["routes"][route])
+        eq_({"sqlite://": None}, stats["replica_lag"])
+
     def test_2(self):
         eq_(0, len(self.store.users()))
 
@@ -36,6 +89,70 @@ class TestStore(StoreFixture):
         self.store.add_user(USER)
         eq_(1, len(self.store.users()))
 
+class TestStoreEvents(StoreFixture):
+
+    def setup(self):
+        super(TestStoreEvents, self).setup()
+        self.changed = []
+        snakepit.data.listen("user_changed", self.changed.append)
+
+    def teardown(self):
+        snakepit.data.unlisten("user_changed", self.changed.append)
+        super(TestStoreEvents, self).teardown()
+
+    def test_role_changes_are_published(self):
+        changed = self.changed
+        with self.store as store:
+            store.add_user({"name": "role user", "email": "role@bar.com", "password": "foo"})
+        eq_([], changed)
+        with self.store as store:
+            u = store.fetch_user(name = "role user")
+            store.grant_role(u, "admin")
+            user_id = u.id
+        eq_([user_id], changed)
+        try:
+            with self.store as store:
+                u = store.fetch_user(name = "role user")
+                store.revoke_role(u, "admin")
+                raise ValueError("abandon transaction")
+        except ValueError:
+            pass
+        eq_([user_id], changed)
+
+class TestSweeper(StoreFixture):
+
+    def test_sweeps_expired_grants_and_tokens(self):
+        past = datetime.utcnow() - timedelta(hours = 1)
+        future = datetime.utcnow() + timedelta(hours = 1)
+        with self.store as store:
+            user = store.add_user({"name": "sweep user", "email": "sweep@bar.com", "password": "foo"})
+            client = Client(id = u"sweep-client", client_secret = u"sweep-secret", user = user)
+            for i, expires in enumerate([past, past, past, future]):
+                store.save_grant(user, client, u"code-%d" % i, None, None, expires)
+                store.session.add(BearerToken(client = client, user = user,
+                    access_token = u"token-%d" % i, expires_at = expires))
+
+        report = snakepit.maintenance.sweep_expired(self.store, batch_size = 2)
+        eq_(3, report["grants"]["deleted"])
+        eq_(2, report["grants"]["batches"])
+        eq_(3, report["tokens"]["deleted"])
+        eq_([u"code-3"], [g.code for g in self.store.session.query(Grant)])
+        eq_([u"token-3"], [t.access_token for t in self.store.session.query(BearerToken)])
+
+    def test_tokens_from_before_expiry_was_stored_are_swept_once_migrated(self):
+        with self.store as store:
+            user = store.fetch_user(name = "legacy user") or \
+                   store.add_user({"name": "legacy user", "email": "legacy@bar.com", "password": "foo"})
+            client = Client(id = u"legacy-client", client_secret = u"legacy-secret", user = user)
+            store.session.add(BearerToken(client = client, user = user, access_token = u"legacy",
+                created_at = datetime.utcnow() - timedelta(hours = 2), expires_in = 3600))
+        with self.store as store:
+            eq_(1, store.migrate_token_expiry())
+            eq_(0, store.migrate_token_expiry())
+        report = snakepit.maintenance.sweep_expired(self.store)
+        eq_(1, report["tokens"]["deleted"])
+        eq_(0, self.store.session.query(BearerToken).filter(BearerToken.access_token == u"legacy").count())
+
 class TestStoreWithUser(StoreFixture):
 
     def setup(self):
@@ -91,6 +208,72 @@ class TestStoreWithHistories(StoreFixture):
         eq_("my search string", h.steps[0].data)
         eq_([1,2,3], h.steps[1].data["where"]["id"])
 
+    def test_can_fetch_step_by_index(self):
+        h = self.user.histories[1]
+        eq_("my search string", self.store.fetch_step(h.id, 0).data)
+        eq_(h.steps[2], self.store.fetch_step(h.id, 2))
+        eq_(None, self.store.fetch_step(h.id, 3))
+
+    def test_history_length(self):
+        eq_([0, 3, 0], [self.store.history_length(h.id) for h in self.user.histories])
+
+    def test_can_list_histories(self):
+        page = self.store.list_histories(self.user.id, limit = 2)
+        eq_([("hist1", 0), ("hist2", 3)], [(h.name, n) for h, n, _ in page])
+        eq_(page[1][0].steps[-1].created_at, page[1][2])
+        last = page[-1][0]
+        rest = self.store.list_histories(self.user.id, after = (last.created_at, last.id))
+        eq_(["hist3"], [h.name for h, _, _ in rest])
+
+    def test_can_get_a_range_of_steps(self):
+        h = self.user.histories[1]
+        forked = self.store.fork_history({"id": h.id}, 2)
+        forked.append_step("http://tools.intermine.org/dummy", "text/plain", "x")
+        eq_([(1, h.steps[1]), (2, forked.steps[2])], forked.steps_between(1, 5))
+
+    def test_can_append_many_steps(self):
+        h = self.user.histories[1]
+        records = [dict(tool = "http://tools.intermine.org/dummy", mimetype = "text/plain", data = str(i)) \
+                for i in range(3)]
+        start, step_ids = self.store.append_steps(h, records, batch_size = 2)
+        eq_(3, start)
+        eq_(6, h.length())
+        eq_(step_ids, [s.id for s in h.steps[3:]])
+        eq_(["0", "1", "2"], [s.data for s in h.steps[3:]])
+        eq_(h.steps[2], h.steps[3].previous_step)
+        eq_(h.steps[4], h.steps[5].previous_step)
+
+    def test_can_trace_ancestry(self):
+        h = self.user.histories[1]
+        forked = self.store.fork_history({"id": h.id}, 2)
+        forked.append_step("http://tools.intermine.org/dummy", "text/plain", "x")
+        eq_([(forked.steps[2], 0), (h.steps[1], 1), (h.steps[0], 2)],
+                [(s, d) for s, d, _, _ in self.store.step_ancestry(forked.steps[2].id)])
+        eq_([(forked.id, 2), (h.id, 1)],
+                [(i, p) for _, _, i, p in self.store.step_ancestry(forked.steps[2].id, 1)])
+
+    def test_can_find_descendants(self):
+        h = self.user.histories[1]
+        forked = self.store.fork_history({"id": h.id}, 2)
+        forked.append_step("http://tools.intermine.org/dummy", "text/plain", "x")
+        found = self.store.step_descendants(h.steps[1].id)
+        eq_([0, 1, 1], [d for _, d, _, _ in found])
+        eq_(set(h.steps[1:] + forked.steps[2:]), set(s for s, _, _, _ in found))
+
+    def test_can_search_step_data(self):
+        h = self.user.histories[1]
+        found = self.store.search_steps(self.user.id, contains = {"where": {"id": [2]}})
+        eq_([(h.steps[1], h.id, 1)], found)
+        found = self.store.search_steps(self.user.id, path = ["name"], value = "my-list")
+        eq_([h.steps[2]], [s for s, _, _ in found])
+        found = self.store.search_steps(self.user.id, path = ["select"])
+        eq_([h.steps[1]], [s for s, _, _ in found])
+        eq_([], self.store.search_steps(self.user.id, contains = {"where": {"id": [4]}}))
+        found = self.store.search_steps(self.user.id, path = ["where", "id", "1"], value = 2)
+        eq_([h.steps[1]], [s for s, _, _ in found])
+        eq_([], self.store.search_steps(self.user.id, path = ["where", "id", "1"], value = 3))
+        eq_([], self.store.search_steps(self.user.id, path = ["where"], value = {"id": [2]}))
+
     def test_steps_have_tools(self):
         h = self.user.histories[1]
         eq_(["keyword-search", "choose-items", "create-list"], [ s.tool.split('/')[-1] \
@@ -121,4 +304,659 @@ class TestStoreWithHistories(StoreFixture):
         assert_false(h.steps[-1] in forked.steps)
         assert_false(forked.steps[-1] in h.steps)
 
+    def test_forks_share_steps(self):
+        h = self.user.histories[1]
+        forked = self.store.fork_history({"id": h.id}, 2)
+        eq_([], forked.links)
+        eq_(2, self.store.history_length(forked.id))
+        eq_(h.steps[1], self.store.fetch_step(forked.id, 1))
+        eq_(None, self.store.fetch_step(forked.id, 2))
+
+    def test_forks_of_forks_point_at_the_owner(self):
+        h = self.user.histories[1]
+        forked = self.store.fork_history({"id": h.id}, 3)
+        forked.append_step("http://tools.intermine.org/dummy", "text/plain", "x")
+        refork = self.store.fork_history({"id": forked.id}, 2)
+        eq_(h, refork.parent)
+        eq_(h.steps[:2], refork.steps)
+        refork = self.store.fork_history({"id": forked.id}, 4)
+        eq_(forked, refork.parent)
+        eq_(forked.steps, refork.steps)
+
+    def test_can_select_parts_of_step_data(self):
+        h = self.user.histories[1]
+        step, values = self.store.select_step_data(h.steps[1].id, [["where", "id", "2"], ["from"], []])
+        eq_(h.steps[1], step)
+        eq_([3, snakepit.data.ANY, {"select": ["Gene.id"], "where": {"id": [1, 2, 3]}}], values)
+
+    def test_step_data_is_decoded_lazily(self):
+        h = self.user.histories[1]
+        self.store.session.expire_all()
+        data = self.store.fetch_step(h.id, 1).data
+        eq_(None, data._value)
+        eq_({"select": ["Gene.id"], "where": {"id": [1, 2, 3]}}, json.loads(data.raw))
+        eq_(["select", "where"], sorted(data))
+        eq_(hash(data), hash(self.store.fetch_step(h.id, 1).data))
+        eq_("my search string", self.store.fetch_step(h.id, 0).data)
+
+    def test_step_data_is_immutable(self):
+        h = self.user.histories[1]
+        self.store.session.expire_all()
+        data = self.store.fetch_step(h.id, 1).data
+        assert_raises(TypeError, data["where"]["id"].append, 4)
+        assert_raises(TypeError, data["select"].__setitem__, 0, "Gene.name")
+        def replace_ids():
+            data["where"]["id"] = []
+        assert_raises(TypeError, replace_ids)
+        eq_([1, 2, 3], data["where"]["id"])
+        eq_(hash(data["where"]), hash(self.store.fetch_step(h.id, 1).data["where"]))
+
+class TestCompression(object):
+
+    def test_large_values_are_packed(self):
+        value = json.dumps(range(10000))
+        packed = snakepit.compression.pack(value)
+        ok_(packed.startswith("gzip:"))
+        ok_(len(packed) < len(value))
+        eq_(value, snakepit.compression.text_of(packed))
+        eq_("[0, 1", snakepit.compression.peek(packed, 5))
+
+    def test_small_values_are_left_alone(self):
+        eq_("[1, 2]", snakepit.compression.pack("[1, 2]"))
+        eq_("[1, 2]", snakepit.compression.text_of("[1, 2]"))
+
+class TestDeltaEncoding(StoreFixture):
+
+    def setup(self):
+        super(TestDeltaEncoding, self).setup()
+        self.store.keyframe_interval = 3
+        self.user = self.store.fetch_user(name = USER["name"]) or self.store.add_user(USER)
+
+    def records(self, n):
+        return [dict(tool = "http://tools.intermine.org/dummy", mimetype = "application/json",
+                     data = {"name": "list", "ids": range(100 + i)}) for i in range(n)]
+
+    def check(self, h, records):
+        eq_([0, 1, 2, 0, 1], [s.depth for s in h.steps])
+        eq_(None, h.steps[1].stored_data)
+        snakepit.delta.frames.clear()
+        other = snakepit.data.Store(CONFIG)
+        try:
+            steps = other.fetch_history(id = h.id).steps
+            eq_([r["data"]["ids"] for r in records], [list(s.data["ids"]) for s in steps])
+        finally:
+            other.close()
+
+    def test_steps_can_be_stored_as_patches(self):
+        h = self.user.new_history("deltas")
+        records = self.records(5)
+        for r in records:
+            h.append_step(**r)
+        self.store.session.commit()
+        self.check(h, records)
+
+    def test_bulk_appends_are_delta_encoded(self):
+        h = self.user.new_history("deltas")
+        self.store.session.commit()
+        records = self.records(5)
+        self.store.append_steps(h, records, batch_size = 2)
+        self.store.session.commit()
+        self.check(h, records)
+
+    def test_delta_encoded_steps_can_be_searched(self):
+        h = self.user.new_history("deltas")
+        self.store.session.commit()
+        self.store.append_steps(h, self.records(5))
+        self.store.session.commit()
+        found = self.store.search_steps(self.user.id, contains = {"ids": [102]})
+        eq_([3, 4], sorted(p for _, history_id, p in found if history_id == h.id))
+        found = self.store.search_steps(self.user.id, path = ["ids", "101"], value = 101)
+        eq_([2, 3, 4], sorted(p for _, history_id, p in found if history_id == h.id))
+
+    def test_delta_columns_can_be_added_to_old_databases(self):
+        with self.store:
+            self.store.session.execute("ALTER TABLE steps DROP COLUMN patch")
+            self.store.session.execute("ALTER TABLE steps DROP COLUMN depth")
+        with self.store:
+            eq_(["patch", "depth"], self.store.migrate_step_deltas())
+        with self.store:
+            eq_([], self.store.migrate_step_deltas())
+
+    def test_patches_round_trip(self):
+        old = {"a": [1, 2, {"b": "c/d"}], "e": True, "f": 1}
+        new = {"a": [1, {"b": "x"}], "e": 1, "g": {"h": None}}
+        ops = snakepit.delta.diff(old, new)
+        eq_(new, snakepit.delta.apply_patch(snakepit.delta.plain(old), ops))
+        eq_([], snakepit.delta.diff(new, new))
+
+class TestHistoryMigration(StoreFixture):
+
+    def test_old_history_tables_are_brought_up_to_date(self):
+        if self.store.__engine__.dialect.name != 'postgresql':
+            raise SkipTest("old databases are made with Postgresql's ALTER TABLE")
+        user = self.store.add_user(dict(name = "old timer", email = "o@foo.com", password = "o"))
+        h = user.new_history("old")
+        for n in range(3):
+            h.append_step("tool", "text/plain", {"n": n})
+        self.store.session.commit()
+        h_id = h.id
+        with self.store:
+            # As it was before steps had positions, and histories forks and versions.
+            for statement in ["ALTER TABLE histories_steps DROP CONSTRAINT histories_steps_pkey",
+                              "ALTER TABLE histories_steps DROP COLUMN position",
+                              "DROP INDEX ix_histories_steps_steps_id",
+                              "ALTER TABLE histories DROP COLUMN parent_id",
+                              "ALTER TABLE histories DROP COLUMN fork_point",
+                              "ALTER TABLE histories DROP COLUMN version",
+                              "DROP INDEX ix_histories_user_created",
+                              "DROP INDEX ix_steps_prev_step_id",
+                              "DROP INDEX ix_oauth2grants_expires"]:
+                self.store.session.execute(statement)
+        with self.store:
+            report = self.store.migrate_histories()
+        eq_(["position", "parent_id", "fork_point", "version"], report["added"])
+        eq_(3, report["numbered"])
+        ok_(report["keyed"])
+        eq_(set(["ix_histories_steps_steps_id", "ix_histories_user_created", "ix_steps_prev_step_id",
+                 "ix_oauth2grants_expires"]), set(report["indexed"]))
+        eq_([{"n": n} for n in range(3)], [s.data for s in self.store.fetch_history(id = h_id).steps])
+        with self.store:
+            self.store.fetch_history(id = h_id).append_step("tool", "text/plain", {"n": 3})
+        eq_(4, self.store.history_length(h_id))
+        with self.store:
+            eq_(dict(added = [], numbered = 0, keyed = False, indexed = []), self.store.migrate_histories())
+
+    def test_steps_table_gains_payloads(self):
+        if self.store.__engine__.dialect.name != 'postgresql':
+            raise SkipTest("old databases are made with Postgresql's ALTER TABLE")
+        with self.store:
+            # As it was before step data was deduplicated.
+            self.store.session.execute("ALTER TABLE steps DROP COLUMN payload_digest")
+            self.store.session.execute("DROP TABLE payloads")
+        with self.store:
+            report = self.store.migrate_step_payloads()
+        eq_(dict(created = True, added = ["payload_digest"], indexed = ["ix_steps_payload_digest"]), report)
+        self.store.deduplicate = True
+        user = self.store.add_user(dict(name = "deduplicator", email = "d@foo.com", password = "d"))
+        h = user.new_history("shared")
+        step = h.append_step("tool", "text/plain", {"shared": True})
+        self.store.session.commit()
+        ok_(step.payload_digest is not None)
+        eq_([{"shared": True}], [s.data for s in self.store.fetch_history(id = h.id).steps])
+        with self.store:
+            eq_(dict(created = False, added = [], indexed = []), self.store.migrate_step_payloads())
+
+    def test_steps_are_numbered_in_chain_order(self):
+        links = [("c", "b"), ("a", None), ("b", "a"), ("x", "gone")]
+        eq_(["a", "b", "c", "x"], snakepit.data.chain_order(links))
+
+class TestDeduplication(StoreFixture):
+
+    def setup(self):
+        super(TestDeduplication, self).setup()
+        self.store.deduplicate = True
+        self.user = self.store.fetch_user(name = USER["name"]) or self.store.add_user(USER)
+
+    def test_identical_data_is_stored_once(self):
+        query = {"select": ["Gene.id"], "where": {"id": [1, 2, 3]}}
+        stored = self.store.session.query(Payload).count()
+        h1, h2 = self.user.new_history("first"), self.user.new_history("second")
+        s1 = h1.append_step("http://tools.intermine.org/choose-items", "application/json", query)
+        s2 = h2.append_step("http://tools.intermine.org/choose-items", "application/json", dict(query))
+        self.store.session.commit()
+        self.store.append_steps(h2, [dict(tool = "http://tools.intermine.org/choose-items",
+                                          mimetype = "application/json", data = query)])
+        self.store.session.commit()
+        eq_(stored + 1, self.store.session.query(Payload).count())
+        eq_(set([s1.payload_digest]), set(s.payload_digest for s in h1.steps + h2.steps))
+        other = snakepit.data.Store(CONFIG)
+        try:
+            eq_([query, query], [s.data for s in other.fetch_history(id = h2.id).steps])
+        finally:
+            other.close()
+
+    def test_deduplicated_steps_can_be_searched(self):
+        h = self.user.new_history("searched")
+        step = h.append_step("http://tools.intermine.org/dummy", "application/json", {"searched": [1, 2]})
+        self.store.session.commit()
+        found = self.store.search_steps(self.user.id, contains = {"searched": [2]})
+        eq_([(step, h.id, 0)], found)
+        found = self.store.search_steps(self.user.id, path = ["searched", "0"], value = 1)
+        eq_([(step, h.id, 0)], found)
+
+    def test_payloads_added_concurrently_are_stored_once(self):
+        text, digest = Payload.encode({"raced": True})
+        with self.store:
+            self.store._add_payloads({digest: text})
+        other = snakepit.data.Store(CONFIG)
+        try:
+            with other:
+                # As if the other transaction had looked before this one committed.
+                other._known_payloads = lambda digests: set()
+                other._add_payloads({digest: text})
+        finally:
+            other.close()
+        with self.store:
+            eq_(1, self.store.session.query(Payload).filter(Payload.digest == digest).delete())
+
+    def test_deduplicated_step_data_is_selected_from_its_payload(self):
+        h = self.user.new_history("selected")
+        step_id = h.append_step("http://tools.intermine.org/dummy", "application/json",
+                                {"a": {"b": [1, 2]}, "c": "not wanted"}).id
+        self.store.session.commit()
+        self.store.session.expunge_all()
+        step, values = self.store.select_step_data(step_id, [["a", "b"], ["missing"]])
+        eq_([[1, 2], snakepit.data.ANY], values)
+        ok_("payload" not in step.__dict__)
+
+    def test_payloads_being_reused_are_not_swept(self):
+        if self.store.__engine__.dialect.name != 'postgresql':
+            raise SkipTest("only Postgresql sweeps concurrently with appends")
+        text, digest = Payload.encode({"reused": True})
+        with self.store:
+            self.store._add_payloads({digest: text})
+        other = snakepit.data.Store(CONFIG)
+        try:
+            # An append that has found the payload, but not yet committed its step.
+            other._add_payloads({digest: text})
+            snakepit.maintenance.sweep_payloads(self.store, grace = -1)
+            eq_(1, self.store.session.query(Payload).filter(Payload.digest == digest).count())
+            self.store.session.rollback()
+            other.session.rollback()
+        finally:
+            other.close()
+        snakepit.maintenance.sweep_payloads(self.store, grace = -1)
+        eq_(0, self.store.session.query(Payload).filter(Payload.digest == digest).count())
+
+    def test_unused_payloads_are_swept(self):
+        h = self.user.new_history("doomed")
+        step_id = h.append_step("http://tools.intermine.org/dummy", "text/plain", "doomed").id
+        self.store.session.commit()
+        report = snakepit.maintenance.sweep_payloads(self.store, grace = 0)
+        eq_(0, report["payloads"]["deleted"])
+        with self.store:
+            self.store.session.query(HistoryStep).filter(HistoryStep.step_id == step_id).delete()
+            self.store.session.query(Step).filter(Step.id == step_id).delete()
+        report = snakepit.maintenance.sweep_payloads(self.store, grace = -1)
+        eq_(1, report["payloads"]["deleted"])
+
+class TestGarbageCollection(StoreFixture):
+
+    def test_unreachable_steps_are_collected(self):
+        user = self.store.add_user(USER)
+        h = user.new_history("doomed")
+        kept = h.append_step("http://tools.intermine.org/dummy", "text/plain", "kept")
+        for data in ["lost", "also lost"]:
+            h.append_step("http://tools.intermine.org/dummy", "text/plain", data)
+        self.store.session.commit()
+        kept_id = kept.id
+        with self.store:
+            self.store.session.query(HistoryStep).filter(HistoryStep.position > 0).delete()
+        report = snakepit.maintenance.collect_garbage(self.store, batch_size = 1)
+        eq_(2, report["steps"]["deleted"])
+        eq_(len('"lost"') + len('"also lost"'), report["steps"]["bytes"])
+        ok_(report["steps"]["complete"])
+        eq_([kept_id], [s.id for s in self.store.session.query(Step)])
+
+    def test_batches_carry_on_after_the_last_step_looked_at(self):
+        user = self.store.add_user(dict(name = "collector", email = "c@foo.com", password = "c"))
+        histories = [user.new_history(name) for name in "abc"]
+        step_ids = sorted(h.append_step("http://tools.intermine.org/dummy", "text/plain", h.name).id for h in histories)
+        self.store.session.commit()
+        with self.store:
+            self.store.session.query(HistoryStep).filter(HistoryStep.step_id.in_(step_ids)).delete(synchronize_session = False)
+        with self.store:
+            eq_((2, 2 * len('"a"'), step_ids[1]), self.store.delete_unreachable_steps(2))
+        with self.store:
+            eq_((1, len('"a"'), None), self.store.delete_unreachable_steps(2, step_ids[1]))
+        eq_(0, self.store.session.query(Step).filter(Step.id.in_(step_ids)).count())
+
+class TestTransfer(StoreFixture):
+
+    def test_export_and_import(self):
+        user = self.store.add_user(USER)
+        h = user.new_history("exported")
+        for i in range(3):
+            h.append_step("http://tools.intermine.org/dummy", "application/json", {"n": i})
+        self.store.session.commit()
+        forked = self.store.fork_history({"id": h.id}, 2)
+        forked.append_step("http://tools.intermine.org/dummy", "text/plain", "forked")
+        self.store.session.commit()
+        user_id, h_id, forked_id = user.id, h.id, forked.id
+        expected = [[s.data for s in h.steps], [s.data for s in forked.steps]]
+
+        lines = list(snakepit.transfer.export_lines(self.store, user_id, batch_size = 2))
+        records = list(snakepit.transfer.read_lines(lines))
+        eq_(["history"] * 2 + ["step"] * 4 + ["link"] * 4, [r["type"] for r in records])
+
+        with self.store:
+            for model in [HistoryStep, History, Step]:
+                self.store.session.query(model).delete()
+        with self.store:
+            counts = self.store.import_histories(user_id, iter(records), batch_size = 3)
+        eq_(dict(history = 2, step = 4, link = 4), counts)
+        h, forked = self.store.fetch_history(id = h_id), self.store.fetch_history(id = forked_id)
+        eq_(expected, [[s.data for s in h.steps], [s.data for s in forked.steps]])
+        eq_(h.steps[1], forked.steps[2].previous_step)
+        eq_(h, forked.parent)
+
+    def test_steps_are_exported_after_the_steps_before_them(self):
+        user = self.store.add_user(dict(name = "ordered", email = "o@foo.com", password = "o"))
+        h = user.new_history("exported")
+        for i in range(3):
+            h.append_step("http://tools.intermine.org/dummy", "application/json", {"n": i})
+        self.store.session.commit()
+        user_id, h_id = user.id, h.id
+        with self.store:
+            for i, s in enumerate(self.store.fetch_history(id = h_id).steps):
+                s.created_at = s.created_at - timedelta(days = i)
+        records = list(self.store.export_histories(user_id))
+        eq_([{"n": i} for i in range(3)], [s.data for kind, s in records if kind == "step"])
+
+    def test_imports_only_refer_to_their_own_or_the_users_records(self):
+        user = self.store.add_user(dict(name = "importer", email = "i@foo.com", password = "i"))
+        other = self.store.add_user(dict(name = "other", email = "other@foo.com", password = "o"))
+        theirs = other.new_history("theirs")
+        step = theirs.append_step("http://tools.intermine.org/dummy", "text/plain", "secret")
+        self.store.session.commit()
+        user_id, theirs_id, step_id = user.id, str(theirs.id), str(step.id)
+        history_id = str(uuid4())
+        history = dict(type = "history", id = history_id, name = "imported",
+                created_at = "2015-01-01T00:00:00", parent_id = None, fork_point = 0)
+        imports = [
+            [dict(history, parent_id = theirs_id)],
+            [history, dict(type = "link", history_id = history_id, position = 0, step_id = step_id)],
+            [dict(type = "link", history_id = theirs_id, position = 1, step_id = step_id)],
+            [history, dict(type = "step", id = str(uuid4()), created_at = "2015-01-01T00:00:00",
+                tool = "http://tools.intermine.org/dummy", mimetype = "text/plain",
+                prev_step_id = step_id, data = "mine")]]
+        for records in imports:
+            with assert_raises(ValueError):
+                with self.store:
+                    self.store.import_histories(user_id, iter(records))
+        eq_([], self.store.session.query(History).filter(History.user_id == user_id).all())
+
+        with self.store:
+            self.store.import_histories(user_id, iter([history]))
+        with assert_raises(snakepit.data.AlreadyImported):
+            with self.store:
+                self.store.import_histories(user_id, iter([history]))
+
+class TestSharding(StoreFixture):
+
+    def setup(self):
+        super(TestSharding, self).setup()
+        self.dir = tempfile.mkdtemp()
+        self.urls = dict((name, "sqlite:///%s/%s.db" % (self.dir, name)) for name in "ab")
+        self.config = dict(DB_URL = CONFIG['DB_URL'], SHARD_PLACEMENT_TTL = 0,
+                DB_SHARDS = ",".join("%s=%s" % item for item in sorted(self.urls.items())))
+        for name in self.urls:
+            snakepit.data.Store(self.config, shard = name).create_db()
+        snakepit.data.placements.clear()
+
+    def teardown(self):
+        with self.store:
+            self.store.session.query(UserShard).delete()
+        super(TestSharding, self).teardown()
+        shutil.rmtree(self.dir)
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        keys = [str(i) for i in range(1000)]
+        before = snakepit.sharding.HashRing(["a", "b"])
+        after = snakepit.sharding.HashRing(["a", "b", "c"])
+        moved = [k for k in keys if before.node_for(k) != after.node_for(k)]
+        eq_(set(["c"]), set(after.node_for(k) for k in moved))
+        ok_(200 < len(moved) < 500)
+
+    def histories(self, shard):
+        store = snakepit.data.Store(self.config, shard = shard)
+        try:
+            return [(h.name, [s.data for s in h.steps]) for h in store.session.query(History)]
+        finally:
+            store.close()
+
+    def test_users_histories_live_on_their_shard(self):
+        with self.store:
+            user = self.store.fetch_user(name = "sharded") or \
+                   self.store.add_user(dict(name = "sharded", email = "s@foo.com", password = "s"))
+            self.store.session.flush()
+            user_id = user.id
+        with snakepit.data.Store(self.config, user_id = user_id) as store:
+            shard = store.shard
+            h = store.fetch_user(id = user_id).new_history("sharded history")
+            h.append_step("tool", "text/plain", {"n": 1})
+            h.append_step("tool", "text/plain", {"n": 2})
+        other = [name for name in self.urls if name != shard][0]
+        expected = [("sharded history", [{"n": 1}, {"n": 2}])]
+        eq_(expected, self.histories(shard))
+        eq_([], self.histories(other))
+
+        # Draining the shard moves the user off it.
+        draining = dict(self.config, DB_DRAINING_SHARDS = shard)
+        with snakepit.data.Store(draining) as directory:
+            eq_([(user_id, shard, other)], directory.misplaced_users())
+        report = snakepit.maintenance.rebalance(draining, wait = 0)
+        eq_(1, report["moved"]["users"])
+        eq_([], self.histories(shard))
+        eq_(expected, self.histories(other))
+        eq_(other, snakepit.data.shard_of(draining, user_id))
+
+        with snakepit.data.Store(self.config) as directory:
+            directory.set_placement(user_id, other, moving = True)
+        snakepit.data.placements.clear()
+        assert_raises(snakepit.data.UserMoving, snakepit.data.shard_of, self.config, user_id)
+        eq_(other, snakepit.data.shard_of(self.config, user_id, read_only = True))
+
+    def test_histories_from_before_sharding_are_kept_until_moved(self):
+        with self.store:
+            user = self.store.add_user(dict(name = "unsharded", email = "u@foo.com", password = "u"))
+            h = user.new_history("old history")
+            h.append_step("tool", "text/plain", {"n": 1})
+            self.store.session.flush()
+            user_id, h_id = user.id, h.id
+        eq_(snakepit.data.MAIN_DATABASE, snakepit.data.shard_of(self.config, user_id))
+        with snakepit.data.Store(self.config, user_id = user_id) as store:
+            eq_([{"n": 1}], [s.data for s in store.fetch_history(id = h_id).steps])
+
+        report = snakepit.maintenance.rebalance(self.config, wait = 0)
+        eq_(1, report["moved"]["users"])
+        shard = snakepit.data.shard_of(self.config, user_id)
+        eq_(snakepit.data.shard_ring(self.config).node_for(str(user_id)), shard)
+        eq_([("old history", [{"n": 1}])], self.histories(shard))
+        eq_(None, self.store.fetch_history(id = h_id))
+
+    def test_concurrent_placements_agree(self):
+        with self.store:
+            user = self.store.add_user(dict(name = "placed", email = "p@foo.com", password = "p"))
+            self.store.session.flush()
+            user_id = user.id
+        with snakepit.data.Store(self.config) as directory:
+            shard, moving = directory.user_placement(user_id)
+        # As if the other request had looked before this one placed them.
+        with snakepit.data.Store(self.config) as directory:
+            eq_(shard, directory._place_user(user_id).shard)
+
+class TestGroupCommit(StoreFixture):
+
+    def test_concurrent_appends_are_committed_together(self):
+        with self.store:
+            user = self.store.fetch_user(name = "grouped") or \
+                   self.store.add_user(dict(name = "grouped", email = "g@foo.com", password = "g"))
+            history_id = user.new_history("grouped").id
+        committer = snakepit.batching.GroupCommitter(lambda: snakepit.data.Store(CONFIG),
+                batch_size = 10, latency = 0.5)
+        outcomes = {}
+
+        def append(n):
+            def work(store):
+                if n == 2:
+                    raise ValueError("bad step")
+                return store.fetch_history(id = history_id).append_step("tool", "text/plain", {"n": n})
+            try:
+                outcomes[n] = committer.submit(work).data
+            except ValueError as e:
+                outcomes[n] = e
+
+        threads = [threading.Thread(target = append, args = (n,)) for n in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        eq_(dict(batches = 1, units = 5, failures = 1, retries = 0, mean_batch_size = 5.0),
+            committer.statistics())
+        ok_(isinstance(outcomes.pop(2), ValueError))
+        eq_(dict((n, {"n": n}) for n in (0, 1, 3, 4)), outcomes)
+        eq_(4, self.store.history_length(history_id))
+
+    def test_units_of_a_batch_that_cannot_be_committed_are_retried_alone(self):
+        commits = []
+
+        class FlakyStore(snakepit.data.Store):
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                commits.append(exc_type)
+                if len(commits) == 1:
+                    self.session.rollback()
+                    raise RuntimeError("commit failed")
+                return super(FlakyStore, self).__exit__(exc_type, exc_val, exc_tb)
+
+        runs = []
+        def work(store):
+            runs.append(store)
+            return len(runs)
+
+        committer = snakepit.batching.GroupCommitter(lambda: FlakyStore(CONFIG), latency = 0)
+        eq_(2, committer.submit(work))
+        eq_(dict(batches = 1, units = 1, failures = 0, retries = 1, mean_batch_size = 1.0),
+            committer.statistics())
+
+class TestConcurrentAppends(StoreFixture):
+
+    def setup(self):
+        super(TestConcurrentAppends, self).setup()
+        with self.store:
+            user = self.store.fetch_user(name = "racer") or \
+                   self.store.add_user(dict(name = "racer", email = "r@foo.com", password = "r"))
+            self.history_id = user.new_history("race").id
+
+    def positions(self):
+        return [p for p, in self.store.session.query(HistoryStep.position).\
+                                   filter(HistoryStep.history_id == self.history_id).\
+                                   order_by(HistoryStep.position)]
+
+    def test_stale_appends_are_refused_and_retried(self):
+        slow = snakepit.data.Store(CONFIG)
+        slow.session.expire_on_commit = False
+        stale = slow.fetch_history(id = self.history_id)
+        slow.session.commit()
+
+        with snakepit.data.Store(CONFIG) as fast:
+            fast.fetch_history(id = self.history_id).append_step("tool", "text/plain", "fast")
+
+        attempts = []
+        def append():
+            attempts.append(len(attempts))
+            try:
+                h = stale if len(attempts) == 1 else slow.fetch_history(id = self.history_id)
+                step = h.append_step("tool", "text/plain", "slow")
+                slow.session.commit()
+            except:
+                slow.session.rollback()
+                raise
+            return step
+        snakepit.data.retrying(append, backoff = 0)
+        eq_(2, len(attempts))
+        eq_([0, 1], self.positions())
+        eq_("slow", self.store.fetch_step(self.history_id, 1).data)
+        slow.close()
+
+    def test_appends_only_lock_the_history_when_committed(self):
+        if self.store.__engine__.dialect.name == 'sqlite':
+            raise SkipTest("needs a database with row level locks")
+        appending = snakepit.data.Store(CONFIG)
+        try:
+            appending.fetch_history(id = self.history_id).append_step("tool", "text/plain", "pending")
+            with snakepit.data.Store(CONFIG) as other:
+                other.session.query(History).filter(History.id == self.history_id).\
+                      with_lockmode("update_nowait").one()
+        finally:
+            appending.close()
+
+    def test_concurrent_appenders_stress(self):
+        # SQLite locks the whole database, so there is no race to test there.
+        if self.store.__engine__.dialect.name == 'sqlite':
+            raise SkipTest("needs a database with row level concurrency")
+        threads, appends, conflicts = 8, 25, []
+
+        def appender():
+            store = snakepit.data.Store(CONFIG)
+            def append():
+                try:
+                    with store:
+                        store.fetch_history(id = self.history_id).append_step("tool", "text/plain", [])
+                except snakepit.data.HistoryConflict:
+                    conflicts.append(1)
+                    raise
+            try:
+                for _ in range(appends):
+                    snakepit.data.retrying(append, attempts = 100, backoff = 0.001)
+            finally:
+                store.close()
+
+        workers = [threading.Thread(target = appender) for _ in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        eq_(range(threads * appends), self.positions())
+        eq_(threads * appends, self.store.history_length(self.history_id))
+        ok_(conflicts)
+
+class TestSubscriptions(StoreFixture):
+
+    def setup(self):
+        super(TestSubscriptions, self).setup()
+        self.hub = snakepit.subscriptions.Hub()
+        self.feed = snakepit.subscriptions.feed(self.hub, CONFIG)
+        ok_(self.feed.wait_ready(10))
+
+    def teardown(self):
+        self.feed.close()
+        super(TestSubscriptions, self).teardown()
+
+    def test_committed_changes_reach_subscribers(self):
+        hub = self.hub
+        with self.store:
+            user = self.store.fetch_user(name = "watched") or \
+                   self.store.add_user(dict(name = "watched", email = "w@foo.com", password = "w"))
+            history_id = user.new_history("watched").id
+        subscription = hub.subscribe(history_id)
+
+        with self.store:
+            self.store.fetch_history(id = history_id).append_step("tool", "text/plain", 1)
+        eq_(("steps", 0, 1), subscription.get(5))
+        with self.store:
+            h = self.store.fetch_history(id = history_id)
+            self.store.append_steps(h, [dict(tool = "tool", mimetype = "text/plain", data = n) for n in (2, 3)])
+        eq_(("steps", 1, 3), subscription.get(5))
+        with self.store:
+            fork_id = self.store.fork_history({"id": history_id}, 1).id
+        eq_(("fork", str(fork_id), 1), subscription.get(5))
+
+        try:
+            with self.store:
+                self.store.fetch_history(id = history_id).append_step("tool", "text/plain", 4)
+                raise ValueError("rolled back")
+        except ValueError:
+            pass
+        eq_(None, subscription.get(0.5))
+        subscription.close()
+        eq_(0, hub.statistics()["subscribers"])
 
+    def test_closed_feeds_stop_publishing(self):
+        hub = snakepit.subscriptions.Hub()
+        started = snakepit.subscriptions.feed(hub, dict(DB_URL = "sqlite://"))
+        eq_(len(snakepit.data.BROADCAST_EVENTS), len(started.handlers))
+        started.close()
+        for event_name in snakepit.data.BROADCAST_EVENTS:
+            eq_([], [h for h in snakepit.data._listeners[event_name] if getattr(h, "func", None) == hub.publish])
@@ -2,7 +2,11 @@ from nose.tools import *
 import snakepit
 import snakepit.webapp as web
 import json
+import zlib
+import time
 from operator import itemgetter
+from uuid import uuid4
+from snakepit.schema import HistoryStep, Step
 
 user = {"name": "Test User", "password": "passw0rd", "email": "user@foo.com"}
 JSON = 'application/json'
@@ -70,6 +74,16 @@ class Client(object):
                 follow_redirects = True,
                 headers          = [accept_json, accept_html])
 
+class TestTokenCache(object):
+
+    def test_revoked_tokens_are_forgotten(self):
+        access, refresh = web.token_key("access_token", "abc"), web.token_key("refresh_token", "def")
+        web.tokens.put(access, "token")
+        web.tokens.put(refresh, "token")
+        web.forget_token("abc", "def")
+        eq_(None, web.tokens.get(access))
+        eq_(None, web.tokens.get(refresh))
+
 class TestFrontDoor(Client):
 
     def test_welcome(self):
@@ -159,6 +173,13 @@ class TestData(Client):
         eq_(1, len(history['steps']))
         ok_(s_url.endswith(history['steps'][0]['url']))
 
+        rv, step = self.api('GET', s_url)
+        eq_(200, rv.status_code)
+        eq_("my search string", step['data'])
+
+        rv, _ = self.api('GET', h_url + '/1')
+        eq_(404, rv.status_code)
+
 
 class TestWithHistory(Client):
 
@@ -213,3 +234,246 @@ class TestWithHistory(Client):
         eq_(2, len(self.history['steps']))
         eq_(n_h + 1, len(self.histories))
 
+    def test_steps_of_deleted_histories_are_not_found(self):
+        eq_(200, self.api('GET', self.h_url + '/0')[0].status_code)
+        eq_(200, self.api('GET', self.h_url + '/1')[0].status_code)
+        # Unlinked and collected by another process, so this one still has the address.
+        with snakepit.data.Store(Client.CONF) as store:
+            link = store.session.query(HistoryStep).\
+                         filter(HistoryStep.history_id == self.h_url.rsplit('/', 1)[1]).\
+                         filter(HistoryStep.position == 1).one()
+            step_id = link.step_id
+            store.session.delete(link)
+            store.session.flush()
+            store.session.query(Step).filter(Step.id == step_id).delete()
+        web.step_responses.clear()
+        eq_(404, self.api('GET', self.h_url + '/1')[0].status_code)
+
+        with snakepit.data.Store(Client.CONF) as store:
+            store.delete_histories(store.fetch_user(name = user['name']).id)
+        eq_(404, self.api('GET', self.h_url + '/0')[0].status_code)
+
+    def test_steps_can_be_revalidated(self):
+        step_url = self.history['steps'][0]['url']
+        rv, _ = self.api('GET', step_url)
+        eq_(200, rv.status_code)
+        ok_('immutable' in rv.headers['Cache-Control'])
+        rv, _ = self.api('GET', step_url, headers = [('If-None-Match', rv.headers['ETag'])])
+        eq_(304, rv.status_code)
+
+    def test_history_etag_changes_with_new_steps(self):
+        rv, _ = self.api('GET', self.h_url)
+        etag = rv.headers['ETag']
+        rv, _ = self.api('GET', self.h_url, headers = [('If-None-Match', etag)])
+        eq_(304, rv.status_code)
+        next_step = json.dumps({
+            'tool': 'http://tools.intermine.org/go-enrichment',
+            'mimetype': 'application/intermine-id-list',
+            'data': [123]
+        })
+        self.api('POST', self.h_url, data = next_step, content_type = JSON)
+        rv, _ = self.api('GET', self.h_url, headers = [('If-None-Match', etag)])
+        eq_(200, rv.status_code)
+
+    def test_step_responses_are_cached(self):
+        query = json.dumps({
+            'tool': 'http://tools.intermine.org/choose-items',
+            'mimetype': 'application/intermine-path-query',
+            'data': {'select': ['Gene.id'], 'where': {'id': [1, 2, 3]}}
+        })
+        r, _ = self.api('POST', self.h_url, data = query, content_type = JSON)
+        step_url = r.headers['Location']
+        hits = web.step_responses.hits
+        rv, step = self.api('GET', step_url)
+        rv, again = self.api('GET', step_url)
+        eq_(step, again)
+        eq_([1, 2, 3], again['data']['where']['id'])
+        eq_(hits + 1, web.step_responses.hits)
+
+    def test_paging_through_steps(self):
+        rv, page = self.api('GET', self.h_url + '?limit=1')
+        eq_(2, page['length'])
+        eq_(1, len(page['steps']))
+        rv, rest = self.api('GET', page['next'])
+        eq_(1, len(rest['steps']))
+        eq_(None, rest['next'])
+        eq_(self.history['steps'], page['steps'] + rest['steps'])
+
+    def test_paging_through_histories(self):
+        histories = self.histories
+        seen, url = [], '/histories?limit=1'
+        while url:
+            rv, page = self.api('GET', url)
+            seen.extend(page['histories'])
+            url = page['next']
+        eq_(histories, seen)
+        eq_(2, seen[-1]['step_count'])
+
+    def test_can_add_many_steps(self):
+        steps = [
+            {"tool": "http://tools.intermine.org/list-upload", "mimetype": "text/plain", "data": "eve"},
+            {"tool": "http://tools.intermine.org/create-list", "mimetype": "application/intermine-id-list", "data": [1]}
+        ]
+        rv, jval = self.api('POST', self.h_url + '/steps', data = json.dumps(steps), content_type = JSON)
+        eq_(201, rv.status_code)
+        eq_([self.h_url + '/2', self.h_url + '/3'], jval['steps'])
+
+        ndjson = "\n".join(json.dumps(step) for step in steps)
+        rv, jval = self.api('POST', self.h_url + '/steps', data = ndjson, content_type = 'application/x-ndjson')
+        eq_(201, rv.status_code)
+        eq_([self.h_url + '/4', self.h_url + '/5'], jval['steps'])
+
+        rv, step = self.api('GET', self.h_url + '/5')
+        eq_([1], step['data'])
+        eq_(6, self.history['length'])
+
+    def test_writes_are_remembered_for_read_your_writes(self):
+        with self.app.session_transaction() as sess:
+            last_write = sess['last_write']
+            ok_(time.time() - last_write < 5)
+        self.api('GET', self.h_url)
+        with self.app.session_transaction() as sess:
+            eq_(last_write, sess['last_write'])
+
+    def test_group_commit(self):
+        web.app.config['GROUP_COMMIT'] = True
+        try:
+            step = {"tool": "http://tools.intermine.org/list-upload", "mimetype": "text/plain", "data": "eve"}
+            rv, jval = self.api('POST', self.h_url, data = json.dumps(step), content_type = JSON)
+            eq_(201, rv.status_code)
+            eq_("eve", jval['data'])
+            rv, jval = self.api('POST', self.h_url + '/2/next', data = json.dumps(step), content_type = JSON)
+            eq_(201, rv.status_code)
+            ok_(rv.headers['Location'].endswith(self.h_url + '/3'))
+            rv, _ = self.api('POST', self.h_url + '/4/next', data = json.dumps(step), content_type = JSON)
+            eq_(404, rv.status_code)
+        finally:
+            web.app.config['GROUP_COMMIT'] = False
+        eq_(4, self.history['length'])
+
+    def test_watching_for_new_steps(self):
+        rv, jval = self.api('GET', self.h_url + '/events?after=0&timeout=0')
+        eq_(200, rv.status_code)
+        eq_([{"event": "step", "position": 1, "url": self.h_url + '/1'}], jval['events'])
+        rv, jval = self.api('GET', self.h_url + '/events?timeout=0')
+        eq_([], jval['events'])
+        rv, jval = self.api('GET', self.h_url + '/events?timeout=-1')
+        eq_(200, rv.status_code)
+        eq_([], jval['events'])
+
+        rv = self.app.get(self.h_url + '/events', buffered = False,
+                headers = [('Accept', 'text/event-stream'), ('Last-Event-ID', '0')])
+        eq_(200, rv.status_code)
+        stream = iter(rv.response)
+        eq_("retry: 2000\n\n", next(stream))
+        ok_(next(stream).startswith("id: 1\nevent: step\n"))
+
+        step = {"tool": "http://tools.intermine.org/list-upload", "mimetype": "text/plain", "data": "eve"}
+        self.api('POST', self.h_url, data = json.dumps(step), content_type = JSON)
+        self.api('POST', self.h_url + '/0/next', data = json.dumps(step), content_type = JSON)
+        event = next(stream)
+        ok_(event.startswith("id: 2\nevent: step\n"))
+        eq_({"position": 2, "url": self.h_url + '/2'}, json.loads(event.split("data: ")[1]))
+        event = next(stream)
+        ok_(event.startswith("event: fork\n"))
+        eq_(1, json.loads(event.split("data: ")[1])['fork_point'])
+        rv.response.close()
+        eq_(0, web.hub.statistics()['subscribers'])
+
+        rv, _ = self.api('GET', '/histories/%s/events' % (uuid4()))
+        eq_(404, rv.status_code)
+
+    def test_bad_batches_add_nothing(self):
+        steps = [{"tool": "http://tools.intermine.org/list-upload", "mimetype": "text/plain", "data": "eve"}, {}]
+        rv, jval = self.api('POST', self.h_url + '/steps', data = json.dumps(steps), content_type = JSON)
+        eq_(400, rv.status_code)
+        eq_(2, self.history['length'])
+
+    def test_lineage(self):
+        rv, ancestry = self.api('GET', self.h_url + '/1/ancestry')
+        eq_([self.h_url + '/1', self.h_url + '/0'], [s['url'] for s in ancestry['steps']])
+        rv, descendants = self.api('GET', self.h_url + '/0/descendants?depth=0')
+        eq_([0], [s['depth'] for s in descendants['steps']])
+
+    def test_search(self):
+        rv, found = self.api('GET', '/steps?contains=[456]&limit=1')
+        eq_([self.h_url + '/1'], [s['url'] for s in found['steps']])
+        rv, found = self.api('GET', '/steps?path=/0&limit=1')
+        eq_([self.h_url + '/1'], [s['url'] for s in found['steps']])
+        rv, found = self.api('GET', '/steps?path=/1&value=0')
+        eq_([], found['steps'])
+        rv, _ = self.api('GET', '/steps?contains={')
+        eq_(400, rv.status_code)
+
+    def test_selecting_fields(self):
+        query = json.dumps({
+            'tool': 'http://tools.intermine.org/choose-items',
+            'mimetype': 'application/intermine-path-query',
+            'data': {'select': ['Gene.id'], 'where': {'id': [1, 2, 3]}}
+        })
+        self.api('POST', self.h_url, data = query, content_type = JSON)
+        step_url = self.h_url + '/2'
+        rv, step = self.api('GET', step_url + '?fields=select,/where/id/1,/missing')
+        eq_({'select': ['Gene.id'], '/where/id/1': 2}, step['data'])
+        eq_('application/intermine-path-query', step['mimetype'])
+        etag = rv.headers['ETag']
+        rv, full = self.api('GET', step_url)
+        ok_(etag != rv.headers['ETag'])
+        eq_([1, 2, 3], full['data']['where']['id'])
+
+    def test_compression(self):
+        threshold = snakepit.compression.threshold
+        snakepit.compression.threshold = 100
+        try:
+            ids = list(range(1000))
+            step = json.dumps({'tool': 'http://tools.intermine.org/create-list',
+                               'mimetype': 'application/intermine-id-list', 'data': ids})
+            self.api('POST', self.h_url, data = step, content_type = JSON)
+        finally:
+            snakepit.compression.threshold = threshold
+        step_url = self.h_url + '/2'
+        for codec in ['gzip', 'deflate']:
+            rv, _ = self.api('GET', step_url, headers = [('Accept-Encoding', codec)])
+            eq_(codec, rv.headers['Content-Encoding'])
+            # Decoded as clients that only read the first gzip member would.
+            body = zlib.decompress(rv.data, snakepit.compression.CODECS[codec])
+            eq_(ids, json.loads(body)['data'])
+        rv, plain = self.api('GET', step_url)
+        ok_('Content-Encoding' not in rv.headers)
+        eq_(ids, plain['data'])
+        for refused in ['gzip;q=0', 'gzip;q=0, deflate;q=0', '*;q=0']:
+            rv, plain = self.api('GET', step_url, headers = [('Accept-Encoding', refused)])
+            ok_('Content-Encoding' not in rv.headers)
+            eq_(ids, plain['data'])
+        rv, _ = self.api('GET', step_url, headers = [('Accept-Encoding', 'gzip;q=0, deflate')])
+        eq_('deflate', rv.headers['Content-Encoding'])
+
+    def test_export_and_import(self):
+        rv = self.app.get('/export', headers = [('Accept', 'application/x-ndjson')])
+        eq_(200, rv.status_code)
+        records = [json.loads(line) for line in rv.data.splitlines()]
+        steps = [r for r in records if r['type'] == 'step']
+        ok_([123, 456, 789] in [s['data'] for s in steps])
+
+        history_id, step_id = str(uuid4()), str(uuid4())
+        export = [
+            {'type': 'history', 'id': history_id, 'name': 'imported', 'created_at': '2015-01-01T00:00:00',
+             'parent_id': None, 'fork_point': 0},
+            {'type': 'step', 'id': step_id, 'created_at': '2015-01-01T00:00:00', 'tool': 'http://tools.intermine.org/dummy',
+             'mimetype': 'text/plain', 'prev_step_id': None, 'data': 'imported'},
+            {'type': 'link', 'history_id': history_id, 'position': 0, 'step_id': step_id}
+        ]
+        ndjson = "\n".join(json.dumps(r) for r in export)
+        rv, jval = self.api('POST', '/import', data = ndjson, content_type = 'application/x-ndjson')
+        eq_(201, rv.status_code)
+        eq_({'history': 1, 'step': 1, 'link': 1}, jval['imported'])
+        rv, step = self.api('GET', '/histories/%s/0' % (history_id))
+        eq_('imported', step['data'])
+
+        rv, jval = self.api('POST', '/import', data = '{"type": "nonsense"}', content_type = 'application/x-ndjson')
+        eq_(400, rv.status_code)
+        rv, jval = self.api('POST', '/import', data = ndjson, content_type = 'application/x-ndjson')
+        eq_(409, rv.status_code)
+        link = {'type': 'link', 'history_id': str(uuid4()), 'position': 0, 'step_id': step_id}
+        rv, jval = self.api('POST', '/import', data = json.dumps(link), content_type = 'application/x-ndjson')
+        eq_(400, rv.status_code)